@@ -1,117 +1,1928 @@
 # -*- coding: utf-8 -*-
+import time
+INIZIO_SCRIPT = time.perf_counter() # Per il rapporto dei tempi di avvio (TempiAvvio)
 import streamlit as st
-from streamlit_gsheets import GSheetsConnection
 import pandas as pd
-import google.generativeai as genai
 from datetime import datetime
-import time
-import gspread
-from google.oauth2.service_account import Credentials
 import urllib.parse
+import threading
+from collections import OrderedDict
+import atexit
+import json
+import os
+import uuid
+import hashlib
+import sqlite3
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import functools
+import itertools
+import io
+import re
+
+# google.generativeai, gspread, google-auth, streamlit_gsheets e pypdf si
+# importano al primo uso (vedi CLIENT ESTERNI): il modulo di login non li usa
 
 # ==========================================
 # CONFIGURAZIONE PAGINA
 # ==========================================
 st.set_page_config(page_title="Health Manager AI", layout="wide", page_icon="🥗")
 
-# Recupero API Key Gemini
-try:
-    genai.configure(api_key=st.secrets["general"]["GEMINI_API_KEY"])
-except Exception as e:
-    st.error(f"Errore Configurazione Gemini: {e}")
-    st.stop()
+# Copy-on-write (sempre attivo da pandas 3): le istantanee in cache sono
+# condivise tra le sessioni e le loro copie non duplicano i dati
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+# ==========================================
+# CLIENT ESTERNI (caricati al primo uso)
+# ==========================================
+class TempiAvvio:
+    """Quanto costa l'avvio del processo, fase per fase, nei log e nelle metriche.
+
+    Gli import di google.generativeai e streamlit_gsheets (che si porta dietro
+    gspread e google-auth) valgono più di un secondo: si fanno solo quando
+    servono davvero e qui si registra la prima volta che succede, insieme al
+    primo disegno della pagina di login.
+    """
+
+    def __init__(self, metriche):
+        self.metriche = metriche
+        self.fasi = {}  # nome -> secondi (solo la prima volta)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def fase(self, nome):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registra(nome, time.perf_counter() - inizio)
 
-# Connessione Database (Legge automaticamente da secrets.toml)
-try:
-    conn = st.connection("gsheets", type=GSheetsConnection)
-except Exception as e:
-    st.error(f"Errore connessione Google Sheets: {e}")
-    st.stop()
+    def registra(self, nome, secondi):
+        with self._lock:
+            if nome in self.fasi:
+                return
+            self.fasi[nome] = secondi
+        self.metriche.imposta("avvio_secondi", round(secondi, 4), fase=nome)
+        print(f"Avvio: {nome} {secondi * 1000:.0f} ms")
+
+    def rapporto(self):
+        return ", ".join(f"{nome} {secondi * 1000:.0f} ms" for nome, secondi in self.fasi.items())
+
+
+@st.cache_resource
+def tempi_avvio():
+    return TempiAvvio(metriche())
+
+
+@st.cache_resource
+def gemini():
+    """google.generativeai configurato, caricato alla prima generazione di un piano"""
+    with tempi_avvio().fase("gemini"):
+        import google.generativeai as genai
+        # Recupero API Key Gemini
+        genai.configure(api_key=st.secrets["general"]["GEMINI_API_KEY"])
+    return genai
+
+
+@st.cache_resource
+def connessione_gsheets():
+    """GSheetsConnection (legge automaticamente da secrets.toml), creata alla prima lettura"""
+    with tempi_avvio().fase("connessione_gsheets"):
+        from streamlit_gsheets import GSheetsConnection
+        return st.connection("gsheets", type=GSheetsConnection)
+
+
+def cella_a1(riga, colonna):
+    """Coordinate A1 (1, 3 -> "C1"); gspread si importa solo per chi lo usa già"""
+    from gspread.utils import rowcol_to_a1
+    return rowcol_to_a1(riga, colonna)
 
 # ==========================================
-# FUNZIONI DATABASE (CRUD)
+# METRICHE (tempi e contatori del processo)
+# ==========================================
+class Metriche:
+    """Tempi (istogrammi), contatori e valori istantanei condivisi da tutte le sessioni.
+
+    Si esportano in formato testo Prometheus (prometheus()) o come dizionario
+    per i log JSON (istantanea()). Le operazioni più lente di soglia_lenta_ms
+    finiscono nel log; con log_json ogni operazione misurata è una riga JSON.
+    """
+
+    # Limiti superiori (secondi) dei bucket degli istogrammi
+    BUCKET = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, soglia_lenta_ms=1000, log_json=False, file_prometheus=None, intervallo_export=15.0):
+        self.soglia_lenta = soglia_lenta_ms / 1000
+        self.log_json = log_json
+        self.file_prometheus = file_prometheus
+        self._contatori = {}  # (nome, etichette) -> valore
+        self._valori = {}     # (nome, etichette) -> valore
+        self._tempi = {}      # (nome, etichette) -> [conteggi per bucket, conteggio, somma, massimo]
+        self._lock = threading.Lock()
+        if file_prometheus:
+            threading.Thread(target=self._ciclo_export, args=(intervallo_export,), name="export-metriche", daemon=True).start()
+
+    @staticmethod
+    def _chiave(nome, etichette):
+        return nome, tuple(sorted((k, str(v)) for k, v in etichette.items()))
+
+    def conta(self, nome, valore=1, **etichette):
+        chiave = self._chiave(nome, etichette)
+        with self._lock:
+            self._contatori[chiave] = self._contatori.get(chiave, 0) + valore
+
+    def imposta(self, nome, valore, **etichette):
+        with self._lock:
+            self._valori[self._chiave(nome, etichette)] = valore
+
+    def osserva(self, nome, secondi, **etichette):
+        chiave = self._chiave(nome, etichette)
+        with self._lock:
+            voce = self._tempi.get(chiave)
+            if voce is None:
+                voce = self._tempi[chiave] = [[0] * len(self.BUCKET), 0, 0.0, 0.0]
+            for i, limite in enumerate(self.BUCKET):
+                if secondi <= limite:
+                    voce[0][i] += 1
+            voce[1] += 1
+            voce[2] += secondi
+            voce[3] = max(voce[3], secondi)
+
+    @contextmanager
+    def span(self, nome, **etichette):
+        """Misura il blocco: durata nell'istogramma `nome`, esito ok/errore.
+
+        st.rerun() e st.stop() non sono errori (non derivano da Exception).
+        """
+        inizio = time.perf_counter()
+        esito = "ok"
+        try:
+            yield
+        except Exception:
+            esito = "errore"
+            raise
+        finally:
+            durata = time.perf_counter() - inizio
+            self.osserva(nome, durata, esito=esito, **etichette)
+            lenta = durata >= self.soglia_lenta
+            if self.log_json:
+                print(json.dumps({
+                    "ts": datetime.now().isoformat(timespec="milliseconds"),
+                    "operazione": nome, "ms": round(durata * 1000, 1),
+                    "esito": esito, "lenta": lenta, **etichette,
+                }, ensure_ascii=False, default=str))
+            elif lenta:
+                dettagli = " ".join(f"{k}={v}" for k, v in etichette.items())
+                print(f"Operazione lenta: {nome} {dettagli} {durata * 1000:.0f} ms ({esito})")
+
+    @staticmethod
+    def _etichette_prometheus(etichette, extra=()):
+        coppie = list(etichette) + list(extra)
+        if not coppie:
+            return ""
+        testo = ",".join(
+            '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in coppie
+        )
+        return "{" + testo + "}"
+
+    def prometheus(self):
+        """Tutte le metriche nel formato testo di Prometheus"""
+        with self._lock:
+            contatori = sorted(self._contatori.items())
+            valori = sorted(self._valori.items())
+            tempi = sorted((k, [list(v[0]), v[1], v[2], v[3]]) for k, v in self._tempi.items())
+        righe = []
+        dichiarate = set()
+
+        def dichiara(nome, tipo):
+            if nome not in dichiarate:
+                dichiarate.add(nome)
+                righe.append(f"# TYPE {nome} {tipo}")
+
+        for (nome, etichette), valore in contatori:
+            dichiara(f"dieta_{nome}_total", "counter")
+            righe.append(f"dieta_{nome}_total{self._etichette_prometheus(etichette)} {valore}")
+        for (nome, etichette), valore in valori:
+            dichiara(f"dieta_{nome}", "gauge")
+            righe.append(f"dieta_{nome}{self._etichette_prometheus(etichette)} {valore}")
+        for (nome, etichette), (bucket, conteggio, somma, _) in tempi:
+            base = f"dieta_{nome}_secondi"
+            dichiara(base, "histogram")
+            for limite, n in zip(self.BUCKET, bucket):
+                righe.append(f"{base}_bucket{self._etichette_prometheus(etichette, [('le', str(limite))])} {n}")
+            righe.append(f"{base}_bucket{self._etichette_prometheus(etichette, [('le', '+Inf')])} {conteggio}")
+            righe.append(f"{base}_sum{self._etichette_prometheus(etichette)} {somma:.6f}")
+            righe.append(f"{base}_count{self._etichette_prometheus(etichette)} {conteggio}")
+        return "\n".join(righe) + "\n"
+
+    def istantanea(self):
+        """Le stesse metriche come liste di dizionari (per JSON e per il pannello)"""
+        with self._lock:
+            return {
+                "contatori": [{"nome": n, **dict(e), "valore": v} for (n, e), v in sorted(self._contatori.items())],
+                "valori": [{"nome": n, **dict(e), "valore": v} for (n, e), v in sorted(self._valori.items())],
+                "tempi": [
+                    {
+                        "nome": n, **dict(e), "chiamate": v[1],
+                        "media_ms": round(1000 * v[2] / v[1], 1), "max_ms": round(1000 * v[3], 1),
+                    }
+                    for (n, e), v in sorted(self._tempi.items())
+                ],
+            }
+
+    def _ciclo_export(self, intervallo):
+        # File per il textfile collector di node_exporter (scrittura atomica)
+        while True:
+            time.sleep(intervallo)
+            try:
+                with open(self.file_prometheus + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(self.prometheus())
+                os.replace(self.file_prometheus + ".tmp", self.file_prometheus)
+            except Exception as e:
+                print(f"Export metriche fallito: {e}")
+
+
+@st.cache_resource
+def metriche():
+    """Metriche del processo, configurabili da secrets.toml ([metriche])"""
+    cfg = st.secrets.get("metriche", {})
+    return Metriche(
+        soglia_lenta_ms=float(cfg.get("soglia_lenta_ms", 1000)),
+        log_json=bool(cfg.get("log_json", False)),
+        file_prometheus=cfg.get("file_prometheus"),
+        intervallo_export=float(cfg.get("intervallo_export_secondi", 15)),
+    )
+
+
+def misurato(nome, **etichette):
+    """Decoratore: ogni esecuzione della funzione è uno span `nome` (es. i fragment)"""
+    def decora(funzione):
+        @functools.wraps(funzione)
+        def avvolta(*args, **kwargs):
+            with metriche().span(nome, **etichette):
+                return funzione(*args, **kwargs)
+        return avvolta
+    return decora
+
+# ==========================================
+# CACHE LETTURE (una voce per foglio)
 # ==========================================
-def leggi_tab(nome_tab):
-    """Legge i dati e li pulisce per evitare errori di login"""
-    df = pd.DataFrame()
+class CacheFogli:
+    """Cache in memoria dei fogli letti, con scadenza (TTL) e limite di memoria.
+
+    Ogni foglio ha la sua voce: una scrittura su CLIENTI tocca solo CLIENTI,
+    le altre voci restano valide. Ogni nuova istantanea di un foglio ha un
+    numero di versione; le istantanee non si modificano mai, si sostituiscono.
+    """
+
+    def __init__(self, ttl_secondi=60, max_fogli=8, max_mb=256):
+        self.ttl_secondi = ttl_secondi
+        self.max_fogli = max_fogli
+        self.max_byte = max_mb * 1024 * 1024
+        self._voci = OrderedDict()  # nome_tab -> (scadenza, byte, dataframe, meta)
+        self._derivati = {}  # (nome_tab, chiave) -> (dataframe, oggetto)
+        self._versioni = {}  # nome_tab -> numero di istantanee salvate
+        self._lock = threading.Lock()
+
+    def leggi(self, nome_tab):
+        with self._lock:
+            voce = self._voci.get(nome_tab)
+            if voce is None:
+                return None
+            scadenza, _, df, _ = voce
+            if time.monotonic() > scadenza:
+                # La voce scaduta resta disponibile per ultima() (sync incrementale)
+                return None
+            self._voci.move_to_end(nome_tab)
+            return df
+
+    def ultima(self, nome_tab):
+        """(dataframe, meta) anche se scaduta, o None: base per leggere solo le righe nuove"""
+        with self._lock:
+            voce = self._voci.get(nome_tab)
+            return None if voce is None else (voce[2], voce[3])
+
+    def salva(self, nome_tab, df, meta=None):
+        """meta=None conserva i metadati della voce precedente (es. righe già sincronizzate).
+
+        Restituisce la memoria occupata dal DataFrame (byte).
+        """
+        byte = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            precedente = self._voci.pop(nome_tab, None)
+            if meta is None:
+                meta = precedente[3] if precedente is not None else {}
+            # Stesso DataFrame = si rinnovano solo scadenza e meta
+            if precedente is None or precedente[2] is not df:
+                self._scarta_derivati(nome_tab)
+                self._versioni[nome_tab] = self._versioni.get(nome_tab, 0) + 1
+            self._voci[nome_tab] = (time.monotonic() + self.ttl_secondi, byte, df, meta)
+            # Libera i fogli usati meno di recente se si superano i limiti
+            while len(self._voci) > 1 and (
+                len(self._voci) > self.max_fogli
+                or sum(v[1] for v in self._voci.values()) > self.max_byte
+            ):
+                vecchio, _ = self._voci.popitem(last=False)
+                self._scarta_derivati(vecchio)
+        return byte
+
+    def versione(self, nome_tab):
+        with self._lock:
+            return self._versioni.get(nome_tab, 0)
+
+    def nomi(self):
+        """Fogli attualmente in cache (anche scaduti)"""
+        with self._lock:
+            return list(self._voci)
+
+    def derivato(self, nome_tab, df, chiave, costruisci):
+        """Oggetto calcolato una sola volta per ogni istantanea del foglio (es. indici)"""
+        with self._lock:
+            voce = self._derivati.get((nome_tab, chiave))
+            if voce is not None and voce[0] is df:
+                return voce[1]
+        oggetto = costruisci(df)
+        with self._lock:
+            # Lo teniamo solo se l'istantanea è ancora quella in cache
+            attuale = self._voci.get(nome_tab)
+            if attuale is not None and attuale[2] is df:
+                self._derivati[(nome_tab, chiave)] = (df, oggetto)
+        return oggetto
+
+    def _scarta_derivati(self, nome_tab):
+        for k in [k for k in self._derivati if k[0] == nome_tab]:
+            del self._derivati[k]
+
+    @staticmethod
+    def concatena(df, righe):
+        """df + righe mantenendo i tipi di df"""
+        nuovo = pd.concat([df, righe], ignore_index=True)
+        # Categorie diverse si uniscono come object: ripristiniamo il tipo dell'istantanea
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype) and not isinstance(nuovo[col].dtype, pd.CategoricalDtype):
+                nuovo[col] = nuovo[col].astype("category")
+        return nuovo
+
+    def accoda_righe(self, nome_tab, righe):
+        """Aggiunge in coda le righe appena scritte, senza riscaricare il foglio"""
+        df = self.leggi(nome_tab)
+        if df is None:
+            return
+        self.salva(nome_tab, self.concatena(df, righe))
+
+    def aggiorna_celle(self, nome_tab, colonna_chiave, valore_chiave, modifiche):
+        """Applica alla voce in cache le stesse modifiche appena scritte su una riga"""
+        df = self.leggi(nome_tab)
+        if df is None or colonna_chiave not in df.columns:
+            return
+        if any(colonna not in df.columns for colonna in modifiche):
+            # Colonna appena aggiunta al foglio: l'istantanea non ce l'ha
+            self.invalida(nome_tab)
+            return
+        # Celle vuote = <NA>: con == il confronto darebbe NA, qui contano come "diverso"
+        posizioni = df[colonna_chiave].eq(valore_chiave).to_numpy(dtype=bool, na_value=False).nonzero()[0]
+        if len(posizioni) == 0:
+            self.invalida(nome_tab)
+            return
+        df = df.copy(deep=False) # Copy-on-write: si copiano solo le colonne modificate
+        for colonna, valore in modifiche.items():
+            tipo = df[colonna].dtype
+            if isinstance(tipo, pd.CategoricalDtype) and not pd.isna(valore) and valore not in tipo.categories:
+                df[colonna] = df[colonna].cat.add_categories([valore])
+            df.iloc[posizioni[0], df.columns.get_loc(colonna)] = valore
+        self.salva(nome_tab, df)
+
+    def invalida(self, nome_tab):
+        with self._lock:
+            self._voci.pop(nome_tab, None)
+            self._scarta_derivati(nome_tab)
+
+
+@st.cache_resource
+def cache_fogli():
+    """Un'unica cache per processo, configurabile da secrets.toml ([cache])"""
+    cfg = st.secrets.get("cache", {})
+    # Con la sonda attiva le istantanee non scadono: le aggiorna lei
+    ttl = float("inf") if float(cfg.get("sonda_secondi", 0)) > 0 else float(cfg.get("ttl_secondi", 60))
+    return CacheFogli(
+        ttl_secondi=ttl,
+        max_fogli=int(cfg.get("max_fogli", 8)),
+        max_mb=float(cfg.get("max_mb", 256)),
+    )
+
+# ==========================================
+# RESILIENZA (quote, nuovi tentativi, circuit breaker)
+# ==========================================
+class LimitatoreRichieste:
+    """Token bucket: al massimo `al_minuto` richieste al minuto, con piccoli picchi fino a `picco`"""
+
+    def __init__(self, al_minuto=60, picco=5):
+        self.al_secondo = al_minuto / 60.0
+        self.picco = picco
+        self._gettoni = float(picco)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def attendi(self):
+        while True:
+            with self._lock:
+                adesso = time.monotonic()
+                self._gettoni = min(self.picco, self._gettoni + (adesso - self._ultimo) * self.al_secondo)
+                self._ultimo = adesso
+                if self._gettoni >= 1:
+                    self._gettoni -= 1
+                    return
+                attesa = (1 - self._gettoni) / self.al_secondo
+            time.sleep(attesa)
+
+
+def stato_http(e):
+    """Codice HTTP dell'errore (gspread, requests, urllib, google.api_core) o None"""
+    risposta = getattr(e, "response", None)
+    codice = getattr(risposta, "status_code", None)
+    if codice is None:
+        codice = getattr(e, "code", None)
+    try:
+        return int(codice) if codice is not None else None
+    except (TypeError, ValueError):
+        return None # es. codici gRPC non numerici
+
+
+def errore_transitorio(e):
+    """True per errori che passano da soli: quota (429), errori del server (5xx), rete"""
+    codice = stato_http(e)
+    if codice is not None:
+        return codice == 429 or codice >= 500
+    # requests e urllib derivano da OSError; TimeoutError e ConnectionError pure
+    return isinstance(e, OSError)
+
+
+class CircuitoAperto(Exception):
+    """API sospesa dopo troppi errori consecutivi: la chiamata non parte nemmeno"""
+
+
+class Resilienza:
+    """Budget di richieste, nuovi tentativi e circuit breaker per una API esterna.
+
+    Ogni chiamata attende un gettone del LimitatoreRichieste (se c'è) e, sugli
+    errori transitori, riprova con backoff esponenziale e jitter (o dopo il
+    Retry-After indicato da Google). Dopo `soglia_errori` fallimenti
+    consecutivi il circuito si apre: per `pausa_secondi` le chiamate
+    falliscono subito con CircuitoAperto, poi ne passa una sola di prova che
+    lo richiude se va a buon fine. Mentre è aperto chi legge usa l'ultima
+    istantanea buona (istantanea_tab) e la metrica api_degradata vale 1.
+
+    Vive in st.cache_resource: chi chiama non deve intercettare CircuitoAperto
+    per tipo (la classe cambia a ogni rerun), basta disponibile().
+    """
+
+    def __init__(self, api, metriche=None, limitatore=None, tentativi=4, base_secondi=0.5,
+                 max_secondi=20.0, soglia_errori=5, pausa_secondi=30.0):
+        self.api = api
+        self.metriche = metriche or Metriche()
+        self.limitatore = limitatore
+        self.tentativi = tentativi
+        self.base_secondi = base_secondi
+        self.max_secondi = max_secondi
+        self.soglia_errori = soglia_errori
+        self.pausa_secondi = pausa_secondi
+        self._errori = 0 # fallimenti transitori consecutivi
+        self._aperto_fino = 0.0
+        self._lock = threading.Lock()
+
+    def disponibile(self):
+        """False se il circuito è aperto (API considerata fuori uso)"""
+        with self._lock:
+            return self._errori < self.soglia_errori or time.monotonic() >= self._aperto_fino
+
+    def _permesso(self):
+        with self._lock:
+            if self._errori < self.soglia_errori:
+                return True
+            adesso = time.monotonic()
+            if adesso < self._aperto_fino:
+                return False
+            # Mezzo aperto: passa solo questa chiamata di prova
+            self._aperto_fino = adesso + self.pausa_secondi
+            return True
+
+    def _successo(self):
+        with self._lock:
+            degradata = self._errori >= self.soglia_errori
+            self._errori = 0
+        if degradata:
+            self.metriche.imposta("api_degradata", 0, api=self.api)
+
+    def _fallimento(self):
+        with self._lock:
+            self._errori += 1
+            apre = self._errori >= self.soglia_errori
+            if apre:
+                self._aperto_fino = time.monotonic() + self.pausa_secondi
+        if apre:
+            self.metriche.conta("circuito_aperto", api=self.api)
+            self.metriche.imposta("api_degradata", 1, api=self.api)
+
+    def attesa(self, tentativo, e):
+        """Secondi prima del nuovo tentativo: full jitter, o Retry-After se più lungo"""
+        attesa = random.uniform(0, min(self.max_secondi, self.base_secondi * 2 ** tentativo))
+        intestazioni = getattr(getattr(e, "response", None), "headers", None) or {}
+        try:
+            attesa = max(attesa, float(intestazioni.get("Retry-After", 0)))
+        except (TypeError, ValueError):
+            pass # Retry-After come data HTTP: si resta sul backoff
+        return min(attesa, self.max_secondi)
+
+    def esegui(self, operazione, nome_operazione="chiamata", idempotente=True, tentativi=None):
+        """operazione() con budget, nuovi tentativi e circuit breaker.
+
+        idempotente=False (es. append_rows) riprova solo sui 429, che Google
+        rifiuta prima di eseguire: dopo un 5xx le righe potrebbero essere già
+        state scritte.
+        """
+        tentativi = tentativi or self.tentativi
+        for tentativo in range(tentativi):
+            if not self._permesso():
+                self.metriche.conta("chiamate_rifiutate", api=self.api, operazione=nome_operazione)
+                raise CircuitoAperto(
+                    f"{self.api} temporaneamente non disponibile, riprova tra {self.pausa_secondi:.0f} secondi."
+                )
+            if self.limitatore is not None:
+                inizio = time.perf_counter()
+                self.limitatore.attendi()
+                self.metriche.osserva("attesa_budget", time.perf_counter() - inizio, api=self.api)
+            try:
+                risultato = operazione()
+            except Exception as e:
+                if not errore_transitorio(e):
+                    raise # Errore nostro o dei dati: riprovare non serve
+                self._fallimento()
+                ripetibile = idempotente or stato_http(e) == 429
+                if not ripetibile or tentativo == tentativi - 1:
+                    raise
+                self.metriche.conta("nuovi_tentativi", api=self.api, operazione=nome_operazione)
+                time.sleep(self.attesa(tentativo, e))
+            else:
+                self._successo()
+                return risultato
+
+
+@st.cache_resource
+def resilienza(api):
+    """Resilienza condivisa dal processo per "sheets" o "gemini" ([resilienza.<api>] in secrets.toml)"""
+    cfg = st.secrets.get("resilienza", {}).get(api, {})
+    if api == "gemini":
+        # Stesso budget della generazione multipla ([gemini] richieste_al_minuto)
+        limitatore = limitatore_gemini()
+    else:
+        # Sheets: nessun budget di default (la quota Google è per progetto e per utente)
+        al_minuto = int(cfg.get("richieste_al_minuto", 0))
+        limitatore = LimitatoreRichieste(al_minuto, int(cfg.get("picco", 10))) if al_minuto > 0 else None
+    return Resilienza(
+        api, metriche(), limitatore,
+        tentativi=int(cfg.get("tentativi", 4)),
+        base_secondi=float(cfg.get("base_secondi", 0.5)),
+        max_secondi=float(cfg.get("max_secondi", 20)),
+        soglia_errori=int(cfg.get("soglia_errori", 5)),
+        pausa_secondi=float(cfg.get("pausa_secondi", 30)),
+    )
+
+# ==========================================
+# CLIENT GSPREAD (condiviso nel processo)
+# ==========================================
+def errore_autenticazione(e):
+    """True se l'errore indica credenziali scadute o revocate"""
+    import google.auth.exceptions
+    import gspread
+    if isinstance(e, google.auth.exceptions.RefreshError):
+        return True
+    risposta = getattr(e, "response", None)
+    return isinstance(e, gspread.exceptions.APIError) and getattr(risposta, "status_code", None) == 401
+
+
+class PoolGspread:
+    """Client gspread autorizzato e handle dei fogli, riusati da tutte le scritture.
+
+    Il token OAuth viene rinnovato in automatico dalla sessione di google-auth;
+    se il rinnovo fallisce o Google risponde 401 si riautorizza e si riprova.
+    Quote (429) ed errori del server passano dalla Resilienza "sheets".
+    """
+
+    SCOPE = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+
+    def __init__(self, creds_dict, url_foglio, metriche=None, resilienza=None):
+        self.creds_dict = creds_dict
+        self.url_foglio = url_foglio
+        # Passate dalla factory: esegui() gira anche nei thread della coda e della sync
+        self.metriche = metriche or Metriche()
+        self.resilienza = resilienza or Resilienza("sheets", self.metriche)
+        self._documento = None
+        self._fogli = {}  # nome_tab -> Worksheet
+        self._lock = threading.Lock()
+
+    def _connetti(self):
+        with self.metriche.span("connessione_gspread"):
+            # Import qui: chi non scrive non paga gspread e google-auth
+            import gspread
+            from google.oauth2.service_account import Credentials
+            creds = Credentials.from_service_account_info(self.creds_dict, scopes=self.SCOPE)
+            client = gspread.authorize(creds)
+            self._documento = client.open_by_url(self.url_foglio)
+            self._fogli = {}
+
+    def documento(self):
+        with self._lock:
+            if self._documento is None:
+                self._connetti()
+            return self._documento
+
+    def foglio(self, nome_tab):
+        with self._lock:
+            if self._documento is None:
+                self._connetti()
+            sheet = self._fogli.get(nome_tab)
+            if sheet is None:
+                sheet = self._fogli[nome_tab] = self._documento.worksheet(nome_tab)
+            return sheet
+
+    def reset(self):
+        with self._lock:
+            self._documento = None
+            self._fogli = {}
+
+    def esegui(self, nome_tab, operazione, nome_operazione="operazione", idempotente=True):
+        """Esegue operazione(sheet); in caso di errore di autenticazione riconnette e riprova una volta.
+
+        Con nome_tab=None l'operazione riceve il documento invece del foglio.
+        idempotente=False per le operazioni da non ripetere dopo un 5xx (append).
+        """
+        bersaglio = self.documento if nome_tab is None else lambda: self.foglio(nome_tab)
+        chiamata = lambda: self.resilienza.esegui(lambda: operazione(bersaglio()), nome_operazione, idempotente)
+        with self.metriche.span("gspread", foglio=nome_tab or "-", operazione=nome_operazione):
+            try:
+                return chiamata()
+            except Exception as e:
+                if not errore_autenticazione(e):
+                    raise
+                self.metriche.conta("riautenticazioni_gspread")
+                self.reset()
+                return chiamata()
+
+
+@st.cache_resource
+def pool_gspread():
+    """Credenziali lette dai Secrets (Cloud Ready), una volta per processo"""
+    # Convertiamo l'oggetto secrets in un dizionario python standard
+    creds_dict = dict(st.secrets["connections"]["gsheets"])
     
-    # 1. TENTATIVO DI LETTURA (Ibrido)
+    # Pulizia della chiave privata (spesso i secrets convertono \n in \\n, qui lo correggiamo)
+    if "private_key" in creds_dict:
+        creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+
+    return PoolGspread(creds_dict, st.secrets["connections"]["gsheets"]["spreadsheet"], metriche(), resilienza("sheets"))
+
+# ==========================================
+# CODA SCRITTURE (opzionale, write-behind)
+# ==========================================
+class CodaScritture:
+    """Raccoglie le righe da aggiungere per foglio e le invia con append_rows a blocchi.
+
+    Ogni riga viene prima salvata in un file di spool locale (una riga JSON):
+    se il processo si ferma, al riavvio le righe non ancora inviate ripartono.
+    L'invio avviene quando un foglio raggiunge max_righe o quando la riga più
+    vecchia aspetta da più di max_attesa secondi.
+
+    Dopo un invio fallito il foglio aspetta sempre di più (backoff fino a
+    max_pausa secondi). Se l'errore non è transitorio (riga non valida, foglio
+    inesistente) si riprova una riga alla volta: la riga che fallisce
+    max_fallimenti volte finisce nel file <foglio>.scartate.jsonl, così le
+    righe dietro di lei ripartono.
+    """
+
+    IN_CODA = "in coda"
+    SALVATO = "salvato"
+    SCARTATO = "non salvato"
+
+    def __init__(self, pool, cartella, max_righe=50, max_attesa=5.0, max_fallimenti=5, max_pausa=300.0):
+        self.pool = pool
+        self.cartella = cartella
+        self.max_righe = max_righe
+        self.max_attesa = max_attesa
+        self.max_fallimenti = max_fallimenti
+        self.max_pausa = max_pausa
+        self._pendenti = {}          # nome_tab -> [(ticket, riga, istante)]
+        self._stati = OrderedDict()  # ticket -> IN_CODA / SALVATO / SCARTATO
+        self._errori = {}            # nome_tab -> (fallimenti consecutivi, prossimo tentativo, una riga alla volta)
+        self._invii = {}             # nome_tab -> Lock: un solo invio per foglio (thread e atexit)
+        self._cond = threading.Condition()
+        os.makedirs(cartella, exist_ok=True)
+        self._recupera_spool()
+        threading.Thread(target=self._ciclo, name="coda-scritture", daemon=True).start()
+        atexit.register(self.svuota_tutto)
+
+    def _file_spool(self, nome_tab):
+        return os.path.join(self.cartella, f"{nome_tab}.jsonl")
+
+    def _file_scartate(self, nome_tab):
+        return os.path.join(self.cartella, f"{nome_tab}.scartate.jsonl")
+
+    def _recupera_spool(self):
+        for nome_file in os.listdir(self.cartella):
+            if not nome_file.endswith(".jsonl") or nome_file.endswith(".scartate.jsonl"):
+                continue
+            nome_tab = nome_file[:-len(".jsonl")]
+            with open(os.path.join(self.cartella, nome_file), encoding="utf-8") as f:
+                for linea in f:
+                    if linea.strip():
+                        voce = json.loads(linea)
+                        self._pendenti.setdefault(nome_tab, []).append((voce["ticket"], voce["riga"], 0.0))
+                        self._stati[voce["ticket"]] = self.IN_CODA
+
+    def _riscrivi_spool(self, nome_tab):
+        """Riscrive lo spool con le sole righe ancora da inviare (chiamare col lock)"""
+        percorso = self._file_spool(nome_tab)
+        temporaneo = percorso + ".tmp"
+        with open(temporaneo, "w", encoding="utf-8") as f:
+            for ticket, riga, _ in self._pendenti.get(nome_tab, []):
+                f.write(json.dumps({"ticket": ticket, "riga": riga}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaneo, percorso)
+
+    def accoda(self, nome_tab, righe):
+        """Mette in coda le righe (liste di stringhe); restituisce il ticket per lo stato"""
+        ticket = uuid.uuid4().hex
+        adesso = time.monotonic()
+        with self._cond:
+            with open(self._file_spool(nome_tab), "a", encoding="utf-8") as f:
+                for riga in righe:
+                    f.write(json.dumps({"ticket": ticket, "riga": riga}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pendenti.setdefault(nome_tab, []).extend((ticket, riga, adesso) for riga in righe)
+            self._stati[ticket] = self.IN_CODA
+            while len(self._stati) > 10000:
+                self._stati.popitem(last=False)
+            self._cond.notify()
+        return ticket
+
+    def stato(self, ticket):
+        with self._cond:
+            return self._stati.get(ticket, self.SALVATO)
+
+    def in_coda(self):
+        with self._cond:
+            return sum(len(v) for v in self._pendenti.values())
+
+    def _pronti(self):
+        adesso = time.monotonic()
+        return [
+            nome_tab for nome_tab, voci in self._pendenti.items()
+            if voci and (len(voci) >= self.max_righe or adesso - voci[0][2] >= self.max_attesa)
+            and adesso >= self._errori.get(nome_tab, (0, 0.0, False))[1]
+        ]
+
+    def _ciclo(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=min(1.0, self.max_attesa))
+                pronti = self._pronti()
+            for nome_tab in pronti:
+                try:
+                    self.svuota(nome_tab)
+                except Exception as e:
+                    # Le righe restano in coda e nello spool: si riprova al giro dopo
+                    print(f"Invio coda {nome_tab} fallito: {e}")
+
+    def _togli(self, nome_tab, blocco, stato):
+        """Toglie il blocco dalla coda e dallo spool (chiamare col lock)"""
+        del self._pendenti[nome_tab][:len(blocco)]
+        self._riscrivi_spool(nome_tab)
+        restanti = {ticket for ticket, _, _ in self._pendenti[nome_tab]}
+        for ticket, _, _ in blocco:
+            # Un salvataggio con anche una sola riga scartata resta "non salvato"
+            if stato == self.SCARTATO or (ticket not in restanti and self._stati.get(ticket) != self.SCARTATO):
+                self._stati[ticket] = stato
+
+    def _fallito(self, nome_tab, blocco, e):
+        """Backoff del foglio; la riga che fallisce sempre va nelle scartate (chiamare col lock)"""
+        fallimenti, _, _ = self._errori.get(nome_tab, (0, 0.0, False))
+        fallimenti += 1
+        # Col circuito aperto l'errore è CircuitoAperto, ma la riga non c'entra
+        una_riga = not errore_transitorio(e) and self.pool.resilienza.disponibile()
+        if una_riga and len(blocco) == 1 and fallimenti >= self.max_fallimenti:
+            with open(self._file_scartate(nome_tab), "a", encoding="utf-8") as f:
+                for ticket, riga, _ in blocco:
+                    f.write(json.dumps({"ticket": ticket, "riga": riga, "errore": str(e)}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._togli(nome_tab, blocco, self.SCARTATO)
+            print(f"Riga di {nome_tab} scartata dopo {fallimenti} tentativi: {e}")
+            fallimenti = 0
+        pausa = min(self.max_pausa, self.max_attesa * 2 ** fallimenti) * random.uniform(0.5, 1.0) if fallimenti else 0.0
+        self._errori[nome_tab] = (fallimenti, time.monotonic() + pausa, una_riga)
+
+    def svuota(self, nome_tab):
+        """Invia un blocco di righe del foglio con un solo append_rows"""
+        with self._cond:
+            invio = self._invii.setdefault(nome_tab, threading.Lock())
+        with invio:
+            with self._cond:
+                # Dopo un errore non transitorio si cerca la riga colpevole una alla volta
+                una_riga = self._errori.get(nome_tab, (0, 0.0, False))[2]
+                blocco = self._pendenti.get(nome_tab, [])[:1 if una_riga else self.max_righe]
+            if not blocco:
+                return
+            try:
+                self.pool.esegui(
+                    nome_tab, lambda sheet: sheet.append_rows([riga for _, riga, _ in blocco]), "append_rows",
+                    idempotente=False,
+                )
+            except Exception as e:
+                with self._cond:
+                    self._fallito(nome_tab, blocco, e)
+                raise
+            with self._cond:
+                self._errori.pop(nome_tab, None)
+                self._togli(nome_tab, blocco, self.SALVATO)
+
+    def svuota_tutto(self):
+        for nome_tab in list(self._pendenti):
+            try:
+                while self._pendenti.get(nome_tab):
+                    self.svuota(nome_tab)
+            except Exception as e:
+                # All'uscita non si aspetta il backoff: le righe restano nello spool
+                print(f"Invio coda {nome_tab} fallito: {e}")
+
+
+@st.cache_resource
+def coda_scritture():
+    """CodaScritture del processo, o None se la scrittura differita è spenta ([scrittura] in secrets.toml)"""
+    cfg = st.secrets.get("scrittura", {})
+    if not cfg.get("differita", False):
+        return None
+    return CodaScritture(
+        pool_gspread(),
+        cartella=cfg.get("cartella_spool", ".spool_scritture"),
+        max_righe=int(cfg.get("max_righe", 50)),
+        max_attesa=float(cfg.get("max_attesa_secondi", 5)),
+        max_fallimenti=int(cfg.get("max_fallimenti", 5)),
+        max_pausa=float(cfg.get("max_pausa_secondi", 300)),
+    )
+
+# ==========================================
+# ARCHIVIO (Google Sheets o SQLite)
+# ==========================================
+class ConflittoAggiornamento(Exception):
+    """La riga sul foglio è cambiata dopo che l'abbiamo letta"""
+
+
+# Esiti di aggiorna_riga degli archivi. Gli archivi vivono in st.cache_resource
+# e sopravvivono ai rerun, mentre le classi dello script vengono ridefinite a
+# ogni esecuzione: per questo restituiscono un esito invece di sollevare
+# ConflittoAggiornamento, che viene sollevata da aggiorna_riga().
+AGGIORNATA = "aggiornata"
+NON_TROVATA = "non trovata"
+
+
+def _stesso_valore(a, b):
+    """Confronto tollerante tra cella del foglio e valore dell'istantanea ("nan" = vuoto, 1234 = 1234.0)"""
+    a, b = str(a).strip(), str(b).strip()
+    a = "" if a in ("nan", "None") else a
+    b = "" if b in ("nan", "None") else b
+    if a == b:
+        return True
     try:
-        # Prova metodo ufficiale
-        df = conn.read(worksheet=nome_tab, ttl=0)
-    except Exception:
-        # Se fallisce, usa metodo CSV (Fallback)
+        return float(a) == float(b)
+    except ValueError:
+        return False
+
+
+class ArchivioSheets:
+    """Archivio su Google Sheets: letture con GSheetsConnection, scritture con gspread"""
+
+    def __init__(self, conn, pool, url_foglio, coda=None, ttl_indici=60):
+        self.conn = conn
+        self.pool = pool
+        self.metriche = pool.metriche
+        self.resilienza = pool.resilienza # Stessa quota Google di gspread
+        self.url_foglio = url_foglio
+        self.coda = coda
+        self.ttl_indici = ttl_indici
+        self._indici = {}  # (nome_tab, colonna) -> (scadenza, intestazione, {valore: [numeri riga]})
+        self._intestazioni = {}  # nome_tab -> (scadenza, intestazione)
+        self._lock = threading.Lock()
+
+    def leggi(self, nome_tab):
+        """DataFrame grezzo del foglio (vuoto se non raggiungibile)"""
+        # 1. TENTATIVO DI LETTURA (Ibrido)
         try:
-            url_sheet = st.secrets["connections"]["gsheets"]["spreadsheet"]
-            sheet_id = url_sheet.split("/d/")[1].split("/")[0]
-            csv_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv&sheet={nome_tab}"
-            df = pd.read_csv(csv_url)
-        except:
-            return pd.DataFrame() # Ritorna vuoto se tutto fallisce
-
-    # 2. PULIZIA DATI (FONDAMENTALE PER IL LOGIN)
-    if not df.empty:
-        # Pulisce i nomi delle colonne (toglie spazi vuoti errati)
-        df.columns = df.columns.str.strip()
-        
-        # Converte TUTTO il contenuto in testo (così 1234 diventa "1234")
-        df = df.astype(str)
-        
-        # Rimuove spazi vuoti prima e dopo ogni parola in tutte le celle
-        for col in df.columns:
+            # Prova metodo ufficiale
+            with self.metriche.span("lettura_foglio", foglio=nome_tab, metodo="connessione"):
+                df = self.resilienza.esegui(lambda: self.conn.read(worksheet=nome_tab, ttl=0), "lettura")
+        except Exception as e:
+            if not self.resilienza.disponibile():
+                # Circuito aperto: niente fallback, si usa l'ultima istantanea buona
+                print(f"Lettura {nome_tab} sospesa: {e}")
+                return pd.DataFrame()
+            # Se fallisce, usa metodo CSV (Fallback)
             try:
-                df[col] = df[col].str.strip()
+                with self.metriche.span("lettura_foglio", foglio=nome_tab, metodo="csv"):
+                    sheet_id = self.url_foglio.split("/d/")[1].split("/")[0]
+                    csv_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv&sheet={nome_tab}"
+                    df = self.resilienza.esegui(lambda: pd.read_csv(csv_url), "lettura_csv")
             except:
-                pass
+                return pd.DataFrame() # Ritorna vuoto se tutto fallisce
+        # Byte = memoria del DataFrame grezzo (la dimensione in rete non è esposta)
+        self.metriche.conta("righe_lette", len(df), foglio=nome_tab)
+        self.metriche.conta("byte_letti", int(df.memory_usage(index=True, deep=True).sum()), foglio=nome_tab)
+        return df
+
+    def _intestazione(self, nome_tab):
+        """Prima riga del foglio (nomi delle colonne), tenuta per ttl_indici secondi"""
+        with self._lock:
+            voce = self._intestazioni.get(nome_tab)
+        if voce is not None and time.monotonic() < voce[0]:
+            return voce[1]
+        intestazione = self.pool.esegui(nome_tab, lambda sheet: sheet.row_values(1), "intestazione")
+        with self._lock:
+            self._intestazioni[nome_tab] = (time.monotonic() + self.ttl_indici, intestazione)
+        return intestazione
+
+    def aggiungi(self, nome_tab, righe_df):
+        """append_rows delle righe (o messa in coda); restituisce il ticket della coda o None"""
+        # append_rows scrive per posizione: stesse colonne del foglio, le nuove in fondo
+        intestazione = [c.strip().lower() for c in self._intestazione(nome_tab)]
+        if intestazione:
+            colonne = intestazione + [c for c in righe_df.columns if c not in intestazione]
+            righe_df = righe_df.reindex(columns=colonne)
+        righe = [["" if pd.isna(x) else str(x) for x in riga] for riga in righe_df.itertuples(index=False)]
+        self._scarta_indici(nome_tab)
+        if self.coda is not None:
+            return self.coda.accoda(nome_tab, righe)
+        self.pool.esegui(nome_tab, lambda sheet: sheet.append_rows(righe), "append_rows", idempotente=False)
+        return None
+
+    supporta_delta = True
+
+    def ultima_modifica(self):
+        """Ora dell'ultima modifica del documento (Drive): una chiamata per tutti i fogli"""
+        return self.pool.esegui(None, lambda documento: documento.get_lastUpdateTime(), "ultima_modifica")
+
+    def righe_da(self, nome_tab, numero_riga, n_colonne):
+        """Valori grezzi (liste di stringhe) dalla riga numero_riga (1 = intestazione) in giù"""
+        ultima_colonna = cella_a1(1, n_colonne).rstrip("0123456789")
+        return self.pool.esegui(nome_tab, lambda sheet: sheet.get(f"A{numero_riga}:{ultima_colonna}"), "get")
+
+    def _scarta_indici(self, nome_tab):
+        with self._lock:
+            for k in [k for k in self._indici if k[0] == nome_tab]:
+                del self._indici[k]
+
+    def _indice(self, nome_tab, colonna):
+        """Intestazione e {valore: [numeri riga]} scaricando una sola colonna"""
+        with self._lock:
+            voce = self._indici.get((nome_tab, colonna))
+        if voce is not None and time.monotonic() < voce[0]:
+            return voce[1], voce[2]
+
+        def operazione(sheet):
+            intestazione = sheet.row_values(1)
+            pos = [c.strip().lower() for c in intestazione].index(colonna)
+            return intestazione, sheet.col_values(pos + 1)
+
+        intestazione, valori = self.pool.esegui(nome_tab, operazione, "indice")
+        righe = {}
+        for numero, valore in enumerate(valori[1:], start=2):
+            righe.setdefault(valore.strip(), []).append(numero)
+        with self._lock:
+            self._indici[(nome_tab, colonna)] = (time.monotonic() + self.ttl_indici, intestazione, righe)
+        return intestazione, righe
+
+    def righe_per_chiave(self, nome_tab, colonna, valore, limite=None, salta=0):
+        """Righe con colonna == valore, dalla più recente: (DataFrame grezzo, totale).
+
+        Scarica solo la colonna chiave (indice in memoria) e poi le righe della
+        pagina richiesta con un unico batch_get. Se nel frattempo le righe sono
+        state cancellate o riordinate sul foglio, l'indice si ricostruisce una
+        volta e le righe con un'altra chiave non si restituiscono mai.
+        """
+        valore = str(valore).strip()
+        for tentativo in range(2):
+            intestazione, indice = self._indice(nome_tab, colonna)
+            numeri = indice.get(valore, [])[::-1]
+            pagina = numeri[salta:salta + limite] if limite is not None else numeri[salta:]
+            if not pagina:
+                return pd.DataFrame(columns=intestazione), len(numeri)
+
+            ultima_colonna = cella_a1(1, len(intestazione)).rstrip("0123456789")
+            intervalli = [f"A{n}:{ultima_colonna}{n}" for n in pagina]
+            risposte = self.pool.esegui(nome_tab, lambda sheet: sheet.batch_get(intervalli), "batch_get")
+            pos = [c.strip().lower() for c in intestazione].index(colonna)
+            righe = []
+            for risposta in risposte:
+                riga = list(risposta[0]) if len(risposta) else []
+                righe.append(riga + [None] * (len(intestazione) - len(riga)))
+            corrette = [r for r in righe if str(r[pos] or "").strip() == valore]
+            if len(corrette) == len(righe):
+                break
+            # Indice vecchio rispetto al foglio: al secondo giro si rilegge la colonna
+            self._scarta_indici(nome_tab)
+        return pd.DataFrame(corrette, columns=intestazione), len(numeri)
+
+    def aggiorna_riga(self, nome_tab, colonna_chiave, valore_chiave, modifiche, attesi=None):
+        def operazione(sheet):
+            intestazione = [c.strip().lower() for c in sheet.row_values(1)]
+            chiavi = sheet.col_values(intestazione.index(colonna_chiave.lower()) + 1)
+            valore = str(valore_chiave).strip()
+            numero_riga = next((i + 1 for i, k in enumerate(chiavi) if i > 0 and k.strip() == valore), None)
+            if numero_riga is None:
+                return NON_TROVATA
+
+            if attesi:
+                attuale = sheet.row_values(numero_riga)
+                for colonna, atteso in attesi.items():
+                    pos = intestazione.index(colonna.lower()) if colonna.lower() in intestazione else len(attuale)
+                    cella = attuale[pos] if pos < len(attuale) else ""
+                    # Cella già col valore nuovo: è il nostro batch_update andato a buon
+                    # fine prima di un 5xx, che la Resilienza sta riprovando
+                    if colonna in modifiche and _stesso_valore(cella, modifiche[colonna]):
+                        continue
+                    if not _stesso_valore(cella, atteso):
+                        return f"'{colonna}' di {valore} è cambiato sul foglio ('{cella}'), ricarica i dati."
+
+            # Colonna che il foglio non ha ancora (es. logo_url): si aggiunge in
+            # fondo all'intestazione, come fa l'archivio SQLite
+            celle = []
+            nuove = [c for c in modifiche if c.lower() not in intestazione]
+            if len(intestazione) + len(nuove) > sheet.col_count:
+                sheet.add_cols(len(intestazione) + len(nuove) - sheet.col_count)
+            for colonna in nuove:
+                intestazione.append(colonna.lower())
+                celle.append({"range": cella_a1(1, len(intestazione)), "values": [[colonna]]})
+            sheet.batch_update(celle + [
+                {
+                    "range": cella_a1(numero_riga, intestazione.index(colonna.lower()) + 1),
+                    "values": [[str(v)]],
+                }
+                for colonna, v in modifiche.items()
+            ])
+            return AGGIORNATA
+
+        esito = self.pool.esegui(nome_tab, operazione, "aggiorna_riga")
+        self._scarta_indici(nome_tab) # L'intestazione può essere cambiata
+        return esito
+
+
+class ArchivioSQLite:
+    """Archivio locale su SQLite: letture in millisecondi e scritture in transazione.
+
+    Ogni foglio è una tabella con colonne TEXT (le intestazioni del foglio),
+    con indici su username, studio_riferimento e cliente_username. Con
+    `remoto` (un ArchivioSheets) le tabelle mancanti si importano dal foglio
+    e ogni scrittura finisce anche in _da_sincronizzare, inviata al foglio
+    ogni `sync_secondi` da un thread in background. Con ":memory:" fa da
+    archivio finto per le prove offline.
+
+    Le operazioni partono in ordine; un errore transitorio (o il circuito
+    aperto) ferma il giro. Un'operazione che fallisce per altri motivi
+    max_fallimenti volte di fila finisce in <percorso>.scartate.jsonl,
+    così le scritture dietro di lei arrivano comunque al foglio.
+    """
+
+    # Le letture locali costano poco: nessuna sincronizzazione incrementale
+    supporta_delta = False
+
+    INDICI = {
+        "CONFIG_STUDI": ["username"],
+        "CLIENTI": ["username", "studio_riferimento"],
+        "DIETE": ["cliente_username"],
+    }
+
+    def __init__(self, percorso, remoto=None, sync_secondi=0, metriche=None, max_fallimenti=5):
+        self.remoto = remoto
+        self.metriche = metriche or Metriche()
+        self.max_fallimenti = max_fallimenti
+        self.file_scartate = None if percorso == ":memory:" else f"{percorso}.scartate.jsonl"
+        self._fallimenti = {} # id operazione -> errori non transitori consecutivi
+        self.ultimo_errore = None
+        self.scartate = 0 # Dall'avvio del processo
+        # Autocommit: le transazioni le apriamo noi con BEGIN IMMEDIATE
+        self._db = sqlite3.connect(percorso, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        if percorso != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS _da_sincronizzare "
+            "(id INTEGER PRIMARY KEY, nome_tab TEXT, operazione TEXT, dati TEXT)"
+        )
+        if remoto is not None and sync_secondi > 0:
+            threading.Thread(target=self._ciclo_sync, args=(sync_secondi,), name="sync-sqlite", daemon=True).start()
+
+    @staticmethod
+    def _q(nome):
+        return '"' + str(nome).replace('"', '""') + '"'
+
+    def _colonne(self, nome_tab):
+        return [r[1] for r in self._db.execute(f"PRAGMA table_info({self._q(nome_tab)})")]
+
+    def _prepara_tabella(self, nome_tab, colonne):
+        esistenti = self._colonne(nome_tab)
+        if not esistenti:
+            definizione = ", ".join(f"{self._q(c)} TEXT" for c in colonne)
+            self._db.execute(f"CREATE TABLE {self._q(nome_tab)} ({definizione})")
+        else:
+            for c in colonne:
+                if c not in esistenti:
+                    self._db.execute(f"ALTER TABLE {self._q(nome_tab)} ADD COLUMN {self._q(c)} TEXT")
+        for c in self.INDICI.get(nome_tab, []):
+            if c in colonne or c in esistenti:
+                self._db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self._q(f'idx_{nome_tab}_{c}')} ON {self._q(nome_tab)} ({self._q(c)})"
+                )
+
+    @staticmethod
+    def _valori(righe_df):
+        # Celle vuote -> NULL, come le celle vuote lette dal foglio
+        return [[None if pd.isna(x) else str(x) for x in riga] for riga in righe_df.itertuples(index=False)]
+
+    def _inserisci(self, nome_tab, righe_df):
+        colonne = [str(c).strip() for c in righe_df.columns]
+        self._prepara_tabella(nome_tab, colonne)
+        segnaposti = ", ".join("?" for _ in colonne)
+        self._db.executemany(
+            f"INSERT INTO {self._q(nome_tab)} ({', '.join(self._q(c) for c in colonne)}) VALUES ({segnaposti})",
+            self._valori(righe_df),
+        )
+        return colonne
+
+    def _transazione(self, operazione):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                risultato = operazione()
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return risultato
+
+    def _importa_se_manca(self, nome_tab):
+        """Prima volta: importa il foglio così com'è. False se la tabella non c'è"""
+        if self._colonne(nome_tab):
+            return True
+        if self.remoto is None:
+            return False
+        df = self.remoto.leggi(nome_tab)
+        if df.empty:
+            return False
+        self._transazione(lambda: self._inserisci(nome_tab, df))
+        return True
+
+    def ultima_modifica(self):
+        """Cambia quando un'altra connessione (es. un altro processo) scrive sul database"""
+        with self._lock:
+            return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def leggi(self, nome_tab):
+        with self._lock:
+            if not self._importa_se_manca(nome_tab):
+                return pd.DataFrame()
+            with self.metriche.span("sqlite", foglio=nome_tab, operazione="leggi"):
+                df = pd.read_sql_query(f"SELECT * FROM {self._q(nome_tab)} ORDER BY rowid", self._db)
+        self.metriche.conta("righe_lette", len(df), foglio=nome_tab)
+        return df
+
+    def _da_sincronizzare(self, nome_tab, operazione, dati):
+        if self.remoto is not None:
+            self._db.execute(
+                "INSERT INTO _da_sincronizzare (nome_tab, operazione, dati) VALUES (?, ?, ?)",
+                (nome_tab, operazione, json.dumps(dati, ensure_ascii=False)),
+            )
+
+    def righe_per_chiave(self, nome_tab, colonna, valore, limite=None, salta=0):
+        """Righe con colonna == valore, dalla più recente (query sull'indice): (DataFrame grezzo, totale)"""
+        with self._lock:
+            self._importa_se_manca(nome_tab)
+            colonne = {c.strip().lower(): c for c in self._colonne(nome_tab)}
+            if colonna not in colonne:
+                return pd.DataFrame(), 0
+            q = self._q
+            filtro = f"FROM {q(nome_tab)} WHERE {q(colonne[colonna])} = ?"
+            with self.metriche.span("sqlite", foglio=nome_tab, operazione="righe_per_chiave"):
+                totale = self._db.execute(f"SELECT COUNT(*) {filtro}", (str(valore),)).fetchone()[0]
+                df = pd.read_sql_query(
+                    f"SELECT * {filtro} ORDER BY rowid DESC LIMIT ? OFFSET ?",
+                    self._db,
+                    params=(str(valore), -1 if limite is None else limite, salta),
+                )
+            return df, totale
+
+    def aggiungi(self, nome_tab, righe_df):
+        def operazione():
+            colonne = self._inserisci(nome_tab, righe_df)
+            self._da_sincronizzare(nome_tab, "aggiungi", {
+                "colonne": colonne,
+                "righe": self._valori(righe_df),
+            })
+        with self._lock:
+            # Prima il foglio esistente, altrimenti la tabella nascerebbe con le sole righe nuove
+            self._importa_se_manca(nome_tab)
+            self._transazione(operazione)
+        return None
+
+    def aggiorna_riga(self, nome_tab, colonna_chiave, valore_chiave, modifiche, attesi=None):
+        def operazione():
+            colonne = {c.strip().lower(): c for c in self._colonne(nome_tab)}
+            if colonna_chiave.lower() not in colonne:
+                return NON_TROVATA
+            q = self._q
+            riga = self._db.execute(
+                f"SELECT rowid, * FROM {q(nome_tab)} WHERE TRIM({q(colonne[colonna_chiave.lower()])}) = ? "
+                "ORDER BY rowid LIMIT 1",
+                (str(valore_chiave).strip(),),
+            ).fetchone()
+            if riga is None:
+                return NON_TROVATA
+            attuale = dict(zip(["rowid"] + self._colonne(nome_tab), riga))
+            for colonna, atteso in (attesi or {}).items():
+                cella = attuale.get(colonne.get(colonna.lower()), "")
+                if not _stesso_valore(cella, atteso):
+                    return f"'{colonna}' di {valore_chiave} è cambiato nell'archivio ('{cella}'), ricarica i dati."
+            for colonna in modifiche:
+                if colonna.lower() not in colonne:
+                    self._prepara_tabella(nome_tab, [colonna])
+                    colonne[colonna.lower()] = colonna
+            assegnazioni = ", ".join(f"{q(colonne[c.lower()])} = ?" for c in modifiche)
+            self._db.execute(
+                f"UPDATE {q(nome_tab)} SET {assegnazioni} WHERE rowid = ?",
+                [str(v) for v in modifiche.values()] + [attuale["rowid"]],
+            )
+            self._da_sincronizzare(nome_tab, "aggiorna", {
+                "colonna_chiave": colonna_chiave,
+                "valore_chiave": str(valore_chiave),
+                "modifiche": {c: str(v) for c, v in modifiche.items()},
+            })
+            return AGGIORNATA
+        with self._lock:
+            self._importa_se_manca(nome_tab)
+            return self._transazione(operazione)
+
+    def da_sincronizzare(self):
+        """Scritture locali non ancora arrivate al foglio"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM _da_sincronizzare").fetchone()[0]
+
+    def sincronizza(self):
+        """Invia al foglio, in ordine, le scritture locali non ancora sincronizzate"""
+        with self._lock:
+            pendenti = self._db.execute(
+                "SELECT id, nome_tab, operazione, dati FROM _da_sincronizzare ORDER BY id"
+            ).fetchall()
+        self.metriche.imposta("sqlite_da_sincronizzare", len(pendenti))
+        for id_, nome_tab, operazione, testo in pendenti:
+            dati = json.loads(testo)
+            try:
+                if operazione == "aggiungi":
+                    righe = [["" if v is None else v for v in riga] for riga in dati["righe"]]
+                    self.remoto.aggiungi(nome_tab, pd.DataFrame(righe, columns=dati["colonne"]))
+                else:
+                    # L'archivio locale è la fonte di verità: nessun controllo sui valori attesi
+                    self.remoto.aggiorna_riga(nome_tab, dati["colonna_chiave"], dati["valore_chiave"], dati["modifiche"])
+            except Exception as e:
+                self.ultimo_errore = f"{nome_tab}: {e}"
+                self.metriche.imposta("sqlite_sync_errore", 1)
+                if errore_transitorio(e) or not self.remoto.pool.resilienza.disponibile():
+                    raise # Si riprende da qui al giro successivo
+                fallimenti = self._fallimenti.get(id_, 0) + 1
+                if fallimenti < self.max_fallimenti:
+                    self._fallimenti[id_] = fallimenti
+                    raise
+                self._scarta(id_, nome_tab, operazione, testo, e)
+                print(f"Scrittura {operazione} su {nome_tab} scartata dopo {fallimenti} tentativi: {e}")
+                continue
+            with self._lock:
+                self._db.execute("DELETE FROM _da_sincronizzare WHERE id = ?", (id_,))
+            self._fallimenti.pop(id_, None)
+        self.ultimo_errore = None
+        self.metriche.imposta("sqlite_sync_errore", 0)
+        self.metriche.imposta("sqlite_da_sincronizzare", self.da_sincronizzare())
+
+    def _scarta(self, id_, nome_tab, operazione, testo, e):
+        if self.file_scartate is not None:
+            with open(self.file_scartate, "a", encoding="utf-8") as f:
+                f.write(json.dumps({
+                    "nome_tab": nome_tab, "operazione": operazione, "dati": json.loads(testo), "errore": str(e),
+                }, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        with self._lock:
+            self._db.execute("DELETE FROM _da_sincronizzare WHERE id = ?", (id_,))
+        self._fallimenti.pop(id_, None)
+        self.scartate += 1
+        self.metriche.conta("sqlite_sync_scartate", foglio=nome_tab, operazione=operazione)
+
+    def _ciclo_sync(self, sync_secondi):
+        while True:
+            time.sleep(sync_secondi)
+            try:
+                self.sincronizza()
+            except Exception as e:
+                # Si riprende dalla stessa operazione al giro successivo
+                print(f"Sincronizzazione SQLite -> Sheets fallita: {e}")
+
+
+def connessione():
+    # Connessione Database
+    try:
+        return connessione_gsheets()
+    except Exception as e:
+        st.error(f"Errore connessione Google Sheets: {e}")
+        st.stop()
+
+
+@st.cache_resource
+def archivio():
+    """Archivio scelto in secrets.toml ([storage] backend = "sheets" | "sqlite")"""
+    cfg = st.secrets.get("storage", {})
+    # Gli indici per chiave (es. piani per cliente) scadono come la cache dei fogli
+    ttl = float(st.secrets.get("cache", {}).get("ttl_secondi", 60))
+    if cfg.get("backend", "sheets") == "sqlite":
+        # Senza sincronizzazione [connections.gsheets] non serve: si lavora offline
+        remoto = None
+        if cfg.get("sincronizza", False):
+            url_foglio = st.secrets["connections"]["gsheets"]["spreadsheet"]
+            remoto = ArchivioSheets(connessione(), pool_gspread(), url_foglio, ttl_indici=ttl)
+        return ArchivioSQLite(
+            cfg.get("percorso", "dieta.db"),
+            remoto=remoto,
+            sync_secondi=float(cfg.get("sync_secondi", 60)),
+            metriche=metriche(),
+            max_fallimenti=int(cfg.get("max_fallimenti", 5)),
+        )
+    url_foglio = st.secrets["connections"]["gsheets"]["spreadsheet"]
+    return ArchivioSheets(connessione(), pool_gspread(), url_foglio, coda=coda_scritture(), ttl_indici=ttl)
+
+# ==========================================
+# FUNZIONI DATABASE (CRUD)
+# ==========================================
+# Tipi delle colonne per foglio. Le colonne non elencate sono "testo".
+#   testo     -> stringa senza spazi ai bordi, cella vuota = <NA>
+#   codice    -> come testo, ma 1234.0 torna 1234 (password, telefoni letti come numeri)
+#   categoria -> pochi valori ripetuti tante volte (meno memoria, confronti veloci)
+#   data      -> datetime (gg/mm/aaaa o gg-mm-aaaa), NaT se vuota o non valida
+SCHEMI = {
+    "CONFIG_STUDI": {
+        "username": "codice",
+        "password": "codice",
+        "data_iscrizione": "data",
+        "data": "data",
+    },
+    "CLIENTI": {
+        "username": "codice",
+        "password": "codice",
+        "telefono": "codice",
+        "studio_riferimento": "categoria",
+    },
+    "DIETE": {
+        "cliente_username": "categoria",
+        "data_assegnazione": "data",
+    },
+}
+
+
+def normalizza_df(nome_tab, df):
+    """Nomi colonne e tipi secondo SCHEMI, con operazioni vettoriali per colonna"""
+    if df.empty:
+        return df
+    df = df.copy()
+    # Pulisce i nomi delle colonne (toglie spazi vuoti errati)
+    df.columns = df.columns.astype(str).str.strip().str.lower()
+    schema = SCHEMI.get(nome_tab, {})
+    
+    for col in df.columns:
+        tipo = schema.get(col, "testo")
+        valori = df[col].astype("string").str.strip()
+        valori = valori.mask(valori == "")
+        
+        if tipo == "codice":
+            # TRUCCO FONDAMENTALE: 1234 letto come numero diventa "1234.0"
+            df[col] = valori.str.replace(r"\.0$", "", regex=True)
+        elif tipo == "categoria":
+            df[col] = valori.astype("category")
+        elif tipo == "data":
+            date = pd.to_datetime(valori, format="%d/%m/%Y", errors="coerce")
+            df[col] = date.fillna(pd.to_datetime(valori, format="%d-%m-%Y", errors="coerce"))
+        else:
+            df[col] = valori
 
     return df
 
 
-def scrivi_tab(nome_tab, dataframe):
-    """Scrive usando gspread leggendo le credenziali dai Secrets (Cloud Ready)"""
+def testo_cella(valore, predefinito=""):
+    """Cella come stringa da mostrare: predefinito se vuota, date in gg/mm/aaaa"""
+    if valore is None or valore is pd.NA or valore is pd.NaT:
+        return predefinito
+    if isinstance(valore, float) and pd.isna(valore):
+        return predefinito
+    if isinstance(valore, (pd.Timestamp, datetime)):
+        return valore.strftime("%d/%m/%Y")
+    return str(valore)
+
+
+def scarica_tab(nome_tab):
+    """Legge il foglio dall'archivio (Sheets o SQLite), senza passare dalla cache"""
+    # 1. LETTURA (vuoto se tutto fallisce)
+    df = archivio().leggi(nome_tab)
+
+    # 2. PULIZIA E TIPI (FONDAMENTALE PER IL LOGIN)
+    return normalizza_df(nome_tab, df)
+
+
+def fogli_solo_aggiunte():
+    """Fogli aggiornati per sola aggiunta ([cache] solo_aggiunte), se l'archivio lo supporta"""
+    if not archivio().supporta_delta:
+        return []
+    return st.secrets.get("cache", {}).get("solo_aggiunte", ["DIETE", "CLIENTI"])
+
+
+def leggi_solo_nuove(nome_tab):
+    """Sync incrementale dei fogli a sola aggiunta: scarica solo le righe nuove.
+
+    Si riparte dall'ultima riga già nota (per controllare che non sia stata
+    modificata) fino in fondo al foglio. Restituisce None quando serve una
+    rilettura completa: foglio non a sola aggiunta, righe modificate o
+    cancellate, colonne nuove, o risincronizza_secondi trascorsi.
+    """
+    cfg = st.secrets.get("cache", {})
+    if nome_tab not in fogli_solo_aggiunte():
+        return None
+    return sincronizza_righe_nuove(cache_fogli(), archivio(), nome_tab, float(cfg.get("risincronizza_secondi", 600)))
+
+
+def sincronizza_righe_nuove(cache, arch, nome_tab, risincronizza_secondi):
+    """Corpo di leggi_solo_nuove senza funzioni st.* (lo usa anche SondaModifiche)"""
+    voce = cache.ultima(nome_tab)
+    if voce is None:
+        return None
+    df, meta = voce
+    n = meta.get("righe_foglio", 0)
+    if n == 0 or time.monotonic() - meta.get("sync_completo", 0) > risincronizza_secondi:
+        return None
+
+    # Riga n+1 del foglio = ultima riga di dati già nota (la riga 1 è l'intestazione)
+    righe = arch.righe_da(nome_tab, n + 1, len(df.columns))
+    base = df.iloc[:n] # Senza le righe aggiunte in cache prima della conferma del foglio
+    if not righe or any(len(r) > len(df.columns) for r in righe):
+        return None
+    nota = righe[0] + [""] * (len(df.columns) - len(righe[0]))
+    if not all(_stesso_valore(v, testo_cella(c)) for v, c in zip(nota, base.iloc[-1])):
+        return None
+
+    nuove = [r + [""] * (len(df.columns) - len(r)) for r in righe[1:]]
+    if nuove:
+        base = CacheFogli.concatena(base, normalizza_df(nome_tab, pd.DataFrame(nuove, columns=df.columns)))
+    elif n == len(df):
+        base = df # Nulla di nuovo: stessa istantanea (e stessa versione)
+    cache.salva(nome_tab, base, meta={**meta, "righe_foglio": n + len(nuove)})
+    return base
+
+
+class Precaricatore:
+    """Letture dei fogli in parallelo su un pool di thread, una sola per foglio.
+
+    Il thread scarica e normalizza il foglio e lo mette in CacheFogli; chi poi
+    chiama istantanea_tab() aspetta la lettura già in corso invece di
+    ripeterla. I thread non chiamano funzioni st.*: cache, archivio e
+    metriche arrivano come argomenti.
+    """
+
+    def __init__(self, max_thread=4):
+        self._pool = ThreadPoolExecutor(max_workers=max_thread, thread_name_prefix="precarica")
+        self._in_corso = {}  # nome_tab -> Future
+        self._lock = threading.Lock()
+
+    def avvia(self, nome_tab, cache, arch, m):
+        with self._lock:
+            futuro = self._in_corso.get(nome_tab)
+            if futuro is None or futuro.done():
+                self._in_corso[nome_tab] = self._pool.submit(self._scarica, nome_tab, cache, arch, m)
+
+    @staticmethod
+    def _scarica(nome_tab, cache, arch, m):
+        with m.span("precaricamento", foglio=nome_tab):
+            df = normalizza_df(nome_tab, arch.leggi(nome_tab))
+        if not df.empty: # Non mettiamo in cache i fallimenti
+            byte = cache.salva(nome_tab, df, meta={"righe_foglio": len(df), "sync_completo": time.monotonic()})
+            m.imposta("cache_fogli_byte", byte, foglio=nome_tab)
+
+    def attendi(self, nome_tab):
+        """Aspetta l'ultima lettura avviata per nome_tab; True se ce n'era una"""
+        with self._lock:
+            futuro = self._in_corso.get(nome_tab)
+        if futuro is None:
+            return False
+        try:
+            futuro.result()
+        except Exception as e:
+            print(f"Precaricamento {nome_tab} fallito: {e}")
+        return True
+
+
+@st.cache_resource
+def precaricatore():
+    """Pool di thread del processo per le letture in anticipo ([cache] thread_precaricamento)"""
+    return Precaricatore(int(st.secrets.get("cache", {}).get("thread_precaricamento", 4)))
+
+
+def precarica(nomi_tab):
+    """Avvia in background le letture dei fogli che la prossima pagina userà.
+
+    Non blocca: la pagina aspetterà solo la lettura più lenta, non la somma.
+    I fogli già in cache si saltano, come quelli scaduti che si aggiornano
+    con la sync incrementale (poche righe, non serve anticiparla).
+    """
+    cache = cache_fogli()
+    arch = archivio()
+    solo_aggiunte = fogli_solo_aggiunte()
+    for nome_tab in nomi_tab:
+        if cache.leggi(nome_tab) is not None:
+            continue
+        if nome_tab in solo_aggiunte and cache.ultima(nome_tab) is not None:
+            continue
+        precaricatore().avvia(nome_tab, cache, arch, metriche())
+
+
+class SondaModifiche:
+    """Un solo thread per processo che tiene aggiornate le istantanee di CacheFogli.
+
+    Ogni `intervallo` secondi chiede all'archivio quando è stato modificato
+    (una chiamata per tutto il documento) e solo se è cambiato rilegge i
+    fogli in cache: le righe nuove per quelli a sola aggiunta, tutto il
+    foglio per gli altri. La nuova versione sostituisce la vecchia in un
+    colpo solo (CacheFogli.salva); chi sta usando quella vecchia la tiene
+    finché gli serve. Così le letture remote dipendono dall'intervallo e non
+    dal numero di sessioni aperte.
+    """
+
+    def __init__(self, cache, arch, m, intervallo=30.0, solo_aggiunte=(), risincronizza_secondi=600):
+        self.cache = cache
+        self.arch = arch
+        self.metriche = m
+        self.intervallo = intervallo
+        self.solo_aggiunte = set(solo_aggiunte)
+        self.risincronizza_secondi = risincronizza_secondi
+        self._ultima_modifica = None
+        threading.Thread(target=self._ciclo, name="sonda-modifiche", daemon=True).start()
+
+    def _ciclo(self):
+        while True:
+            time.sleep(self.intervallo)
+            try:
+                self.controlla()
+            except Exception as e:
+                # Le istantanee restano quelle di prima: si riprova al giro dopo
+                self.metriche.conta("errori_sonda")
+                print(f"Controllo modifiche fallito: {e}")
+
+    def controlla(self):
+        modifica = self.arch.ultima_modifica()
+        if modifica is not None and modifica == self._ultima_modifica:
+            return
+        for nome_tab in self.cache.nomi():
+            with self.metriche.span("sonda", foglio=nome_tab):
+                self._aggiorna(nome_tab)
+            self.metriche.imposta("versione_foglio", self.cache.versione(nome_tab), foglio=nome_tab)
+        self._ultima_modifica = modifica
+
+    def _aggiorna(self, nome_tab):
+        if nome_tab in self.solo_aggiunte and sincronizza_righe_nuove(
+            self.cache, self.arch, nome_tab, self.risincronizza_secondi
+        ) is not None:
+            return
+        df = normalizza_df(nome_tab, self.arch.leggi(nome_tab))
+        if df.empty:
+            return # Foglio non raggiungibile: si tiene l'istantanea attuale
+        voce = self.cache.ultima(nome_tab)
+        if voce is not None and voce[0].equals(df):
+            df = voce[0] # Nessuna modifica: stessa versione, indici già costruiti
+        self.cache.salva(nome_tab, df, meta={"righe_foglio": len(df), "sync_completo": time.monotonic()})
+
+
+@st.cache_resource
+def sonda_modifiche():
+    """SondaModifiche del processo, o None se spenta ([cache] sonda_secondi = 0, il default)"""
+    cfg = st.secrets.get("cache", {})
+    intervallo = float(cfg.get("sonda_secondi", 0))
+    if intervallo <= 0:
+        return None
+    return SondaModifiche(
+        cache_fogli(), archivio(), metriche(), intervallo,
+        solo_aggiunte=fogli_solo_aggiunte(),
+        risincronizza_secondi=float(cfg.get("risincronizza_secondi", 600)),
+    )
+
+
+def istantanea_tab(nome_tab, forza=False):
+    """DataFrame in cache del foglio (da NON modificare: è condiviso)"""
+    sonda_modifiche() # Avvia la sonda al primo uso, se attiva
+    cache = cache_fogli()
+    m = metriche()
+    df = None if forza else cache.leggi(nome_tab)
+    if df is None and not forza and precaricatore().attendi(nome_tab):
+        # Lettura già avviata da precarica(): il risultato è in cache
+        df = cache.leggi(nome_tab)
+        if df is not None:
+            m.conta("cache_fogli", foglio=nome_tab, esito="precaricato")
+            return df
+    if df is not None:
+        m.conta("cache_fogli", foglio=nome_tab, esito="hit")
+        return df
+    if not forza:
+        try:
+            with m.span("sync_incrementale", foglio=nome_tab):
+                df = leggi_solo_nuove(nome_tab)
+        except Exception as e:
+            print(f"Sync incrementale {nome_tab} fallita, rilettura completa: {e}")
+    if df is not None:
+        m.conta("cache_fogli", foglio=nome_tab, esito="delta")
+    else:
+        m.conta("cache_fogli", foglio=nome_tab, esito="miss")
+        df = scarica_tab(nome_tab)
+        if df.empty:
+            # Backend in difficoltà: meglio l'ultima istantanea buona (anche
+            # scaduta) di un foglio vuoto, che farebbe fallire i login
+            voce = cache.ultima(nome_tab)
+            if voce is not None:
+                m.conta("cache_fogli", foglio=nome_tab, esito="degradato")
+                return voce[0]
+            return df # Non mettiamo in cache i fallimenti
+        byte = cache.salva(nome_tab, df, meta={"righe_foglio": len(df), "sync_completo": time.monotonic()})
+        m.imposta("cache_fogli_byte", byte, foglio=nome_tab)
+    m.imposta("cache_fogli_righe", len(df), foglio=nome_tab)
+    return df
+
+
+def leggi_tab(nome_tab, forza=False):
+    """Legge i dati e li pulisce per evitare errori di login (con cache per foglio)"""
+    # Copia: chi chiama può modificare il DataFrame senza sporcare la cache.
+    # Con copy-on-write è una vista: i dati si copiano solo se si modificano
+    return istantanea_tab(nome_tab, forza).copy(deep=False)
+
+
+class RubricaUtenti:
+    """Indici hash su un'istantanea di CONFIG_STUDI o CLIENTI.
+
+    La normalizzazione (strip, fix ".0" delle password) è già fatta da
+    normalizza_df; qui si costruiscono una volta sola gli indici e le
+    ricerche sono poi O(1).
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._esatti = {}     # username -> posizione
+        self._minuscoli = {}  # username minuscolo -> posizione
+        self._per_studio = {} # studio_riferimento -> array di posizioni
+        self._clienti = {}    # (studio_riferimento, username) -> posizione
+        if 'username' not in df.columns:
+            return
+
+        studi = df['studio_riferimento'] if 'studio_riferimento' in df.columns else [None] * len(df)
+        for pos, (username, studio) in enumerate(zip(df['username'], studi)):
+            if username is pd.NA:
+                continue
+            # Vince la prima riga, come faceva check.iloc[0]
+            self._esatti.setdefault(username, pos)
+            self._minuscoli.setdefault(username.lower(), pos)
+            self._clienti.setdefault((studio, username), pos)
+        if 'studio_riferimento' in df.columns:
+            self._per_studio = df.groupby('studio_riferimento', observed=True, sort=False).indices
+
+    @property
+    def vuota(self):
+        return not self._esatti
+
+    def trova(self, username, ignora_maiuscole=True):
+        """Riga dell'utente (Series) o None"""
+        username = str(username).strip()
+        if ignora_maiuscole:
+            pos = self._minuscoli.get(username.lower())
+        else:
+            pos = self._esatti.get(username)
+        return None if pos is None else self.df.iloc[pos].copy()
+
+    def verifica(self, username, password, ignora_maiuscole=True):
+        """Riga dell'utente se le credenziali sono corrette, altrimenti None"""
+        riga = self.trova(username, ignora_maiuscole)
+        if riga is None or testo_cella(riga.get('password')) != str(password).strip():
+            return None
+        return riga
+
+    def clienti_di(self, studio):
+        """Clienti collegati a uno studio (DataFrame, anche vuoto)"""
+        return self.df.iloc[self._per_studio.get(studio, [])]
+
+    def cliente_di(self, studio, username):
+        """Riga del paziente dello studio (Series) o None: lo stesso username
+        può esistere anche in altri studi"""
+        pos = self._clienti.get((studio, str(username).strip()))
+        return None if pos is None else self.df.iloc[pos].copy()
+
+
+def rubrica(nome_tab):
+    """RubricaUtenti dell'istantanea corrente, costruita una volta per istantanea"""
+    df = istantanea_tab(nome_tab)
+    if df.empty:
+        return RubricaUtenti(df)
+    return cache_fogli().derivato(nome_tab, df, "rubrica", RubricaUtenti)
+
+
+def get_studio_info(username_studio):
+    """Riga di CONFIG_STUDI dello studio di riferimento di un cliente (Series) o None"""
+    username_studio = testo_cella(username_studio)
+    if not username_studio:
+        return None
+    return rubrica("CONFIG_STUDI").trova(username_studio)
+
+
+def storico_piani(cliente, salta=0, limite=5):
+    """Piani del cliente dal più recente, `limite` alla volta: (DataFrame, totale).
+
+    Se DIETE è già in cache si usa un indice per cliente sull'istantanea;
+    altrimenti l'archivio scarica solo le righe della pagina. Se l'archivio
+    non risponde si ripiega sull'ultima istantanea buona, anche scaduta; se
+    non c'è si avvisa e si restituisce (DataFrame vuoto, None).
+    """
+    cache = cache_fogli()
+    df = cache.leggi("DIETE")
+    if df is not None and 'cliente_username' in df.columns:
+        return _piani_da_istantanea(cache, df, cliente, salta, limite)
+
     try:
-        # 1. Definisci gli ambiti
-        scope = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
+        righe, totale = archivio().righe_per_chiave("DIETE", "cliente_username", cliente, limite=limite, salta=salta)
+    except Exception as e:
+        voce = cache.ultima("DIETE")
+        if voce is not None and 'cliente_username' in voce[0].columns:
+            metriche().conta("cache_fogli", foglio="DIETE", esito="degradato")
+            return _piani_da_istantanea(cache, voce[0], cliente, salta, limite)
+        print(f"Storico piani di {cliente} non disponibile: {e}")
+        st.warning("⚠️ Archivio dei piani momentaneamente non raggiungibile, riprova tra poco.")
+        return pd.DataFrame(columns=list(SCHEMI["DIETE"])), None
+    return normalizza_df("DIETE", righe), totale
+
+
+def _piani_da_istantanea(cache, df, cliente, salta, limite):
+    """Pagina di storico_piani da un'istantanea di DIETE, con indice per cliente"""
+    indice = cache.derivato(
+        "DIETE", df, "per_cliente",
+        lambda d: d.groupby('cliente_username', observed=True, sort=False).indices,
+    )
+    posizioni = indice.get(cliente, [])[::-1]
+    return df.iloc[posizioni[salta:salta + limite]], len(posizioni)
+
+
+def scrivi_righe(nome_tab, righe_df):
+    """Aggiunge in fondo al foglio tutte le righe del DataFrame in un'unica scrittura.
+
+    Con la scrittura differita attiva le righe vanno nella CodaScritture e lo
+    stato ("salvato" / "in coda") si legge con stato_ultima_scrittura().
+    """
+    try:
+        st.session_state.ultima_scrittura = archivio().aggiungi(nome_tab, righe_df)
         
-        # 2. CREAZIONE CREDENZIALI DAI SECRETS (Invece che dal file fisico)
-        # Convertiamo l'oggetto secrets in un dizionario python standard
-        creds_dict = dict(st.secrets["connections"]["gsheets"])
+        # Aggiorna solo la voce di questo foglio (write-through)
+        cache_fogli().accoda_righe(nome_tab, normalizza_df(nome_tab, righe_df))
+        return True
         
-        # Pulizia della chiave privata (spesso i secrets convertono \n in \\n, qui lo correggiamo)
-        if "private_key" in creds_dict:
-             creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+    except Exception as e:
+        st.error(f"❌ Errore GSPREAD: {e}")
+        return False           
+
+
+def scrivi_tab(nome_tab, dataframe):
+    """Aggiunge l'ultima riga del DataFrame al foglio (client gspread riusato)"""
+    return scrivi_righe(nome_tab, dataframe.iloc[[-1]])
+
+
+def aggiorna_riga(nome_tab, colonna_chiave, valore_chiave, modifiche, attesi=None):
+    """Scrive solo le celle modificate della riga con colonna_chiave == valore_chiave.
+
+    attesi: valori che le stesse celle avevano nella nostra istantanea. Se sul
+    foglio sono diversi qualcun altro ha modificato la riga nel frattempo e si
+    solleva ConflittoAggiornamento invece di sovrascrivere.
+    Restituisce False se la riga non esiste.
+    """
+    # Le celle che non cambiano rispetto all'istantanea non si riscrivono
+    attesi = attesi or {}
+    modifiche = {
+        c: v for c, v in modifiche.items()
+        if c not in attesi or not _stesso_valore(v, attesi[c])
+    }
+    if not modifiche:
+        return True
+
+    esito = archivio().aggiorna_riga(nome_tab, colonna_chiave, valore_chiave, modifiche, attesi)
+    if esito == NON_TROVATA:
+        return False
+    if esito != AGGIORNATA:
+        raise ConflittoAggiornamento(esito)
+    # In cache gli stessi tipi dell'istantanea ("" -> <NA>, date, categorie)
+    valori = normalizza_df(nome_tab, pd.DataFrame([modifiche])).iloc[0].to_dict()
+    cache_fogli().aggiorna_celle(nome_tab, colonna_chiave, str(valore_chiave).strip(), valori)
+    return True
+
+
+def stato_sync():
+    """Scritture dell'archivio SQLite non ancora sul foglio (nella sidebar)"""
+    arch = archivio()
+    if getattr(arch, "remoto", None) is None:
+        return
+    pendenti = arch.da_sincronizzare()
+    if pendenti:
+        st.caption(f"🔄 {pendenti} modifiche da sincronizzare col foglio")
+    if arch.ultimo_errore:
+        st.caption(f"⚠️ Sincronizzazione col foglio non riuscita: {arch.ultimo_errore}")
+    if arch.scartate:
+        st.caption(f"❌ {arch.scartate} modifiche non arrivate al foglio (vedi {arch.file_scartate or 'log'})")
+
+
+def stato_ultima_scrittura():
+    """"salvato" o "in coda" per l'ultima scrittura di questa sessione"""
+    ticket = st.session_state.get("ultima_scrittura")
+    coda = coda_scritture()
+    if ticket is None or coda is None:
+        return CodaScritture.SALVATO
+    return coda.stato(ticket)
+
+
+# Colonne di CLIENTI nell'ordine del form "nuovo paziente" (se il foglio è ancora vuoto)
+COLONNE_CLIENTI = [
+    "username", "password", "nome_completo", "studio_riferimento",
+    "dati_fisici", "obiettivo_specifico", "email", "telefono",
+]
+OBBLIGATORI_CLIENTI = ["username", "password", "nome_completo"]
+
+
+def leggi_file_clienti(file):
+    """DataFrame di stringhe da un CSV o XLSX caricato (celle vuote = "")"""
+    if file.name.lower().endswith(".xlsx"):
+        # pd.read_excel usa openpyxl (opzionale: ImportError se manca)
+        df = pd.read_excel(file, dtype=str, keep_default_na=False)
+    else:
+        # sep=None: virgola o punto e virgola (CSV salvati da Excel in italiano)
+        df = pd.read_csv(file, dtype=str, keep_default_na=False, sep=None, engine="python", encoding="utf-8-sig")
+    df.columns = df.columns.astype(str).str.strip().str.lower()
+    return df
+
+
+def valida_import_clienti(df, esistenti, studio):
+    """Controlla tutte le righe insieme: (righe valide, report con l'esito di ogni riga).
+
+    Errori: campi obbligatori vuoti, username ripetuto nel file o già presente
+    su CLIENTI (`esistenti`), email o telefono non validi. Lo studio di
+    riferimento è sempre quello che importa.
+    """
+    df = df.reindex(columns=list(dict.fromkeys(COLONNE_CLIENTI + list(df.columns))), fill_value="")
+    df = df.apply(lambda col: col.astype("string").fillna("").str.strip())
+    # 393330000000.0 (telefono salvato come numero da Excel) -> 393330000000
+    df["telefono"] = df["telefono"].str.replace(r"\.0$", "", regex=True)
+    df["studio_riferimento"] = studio
 
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        
-        # 3. Apri il foglio
-        url_foglio = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        sheet = client.open_by_url(url_foglio).worksheet(nome_tab)
-        
-        # 4. Prepara l'ultima riga
-        ultima_riga = dataframe.iloc[-1].tolist()
-        ultima_riga = [str(x) for x in ultima_riga]
-        
-        # 5. Aggiungi
-        sheet.append_row(ultima_riga)
-        
-        st.cache_data.clear()
-        return True
-        
-    except Exception as e:
-        st.error(f"❌ Errore GSPREAD: {e}")
-        return False           
+    controlli = [(df[c] == "", f"{c} mancante") for c in OBBLIGATORI_CLIENTI]
+    con_username = df["username"] != ""
+    controlli += [
+        (con_username & df["username"].duplicated(keep="first"), "username ripetuto nel file"),
+        (con_username & df["username"].isin(esistenti), "username già esistente"),
+        ((df["email"] != "") & ~df["email"].str.fullmatch(r"[^@\s]+@[^@\s]+\.[^@\s]+"), "email non valida"),
+        ((df["telefono"] != "") & ~df["telefono"].str.replace(r"[\s+]", "", regex=True).str.fullmatch(r"\d{6,15}"), "telefono non valido"),
+    ]
+    errori = pd.Series("", index=df.index, dtype="string")
+    for errata, messaggio in controlli:
+        errori = errori.mask(errata, errori + messaggio + "; ")
+    errori = errori.str.rstrip("; ")
+
+    report = pd.DataFrame({
+        "riga": df.index + 2, # Numero di riga nel file (1 = intestazione)
+        "username": df["username"],
+        "esito": errori.mask(errori == "", "ok"),
+    })
+    return df[errori == ""], report
 
 # ==========================================
 # FUNZIONI AI (GEMINI)
 # ==========================================
-def genera_piano_nutrizionale(testo_input, stile_studio, obiettivo_cliente, dati_fisici):
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    
-    prompt = f"""
+MODELLO_GEMINI = 'gemini-2.5-flash'
+
+
+def componi_prompt(testo_input, stile_studio, obiettivo_cliente, dati_fisici):
+    return f"""
     Agisci come un nutrizionista professionista.
     
     LINEE GUIDA DELLO STUDIO (Brand):
@@ -130,13 +1941,686 @@ def genera_piano_nutrizionale(testo_input, stile_studio, obiettivo_cliente, dati
     2. Adatta lo stile alle linee guida dello studio.
     3. Usa un tono professionale ed empatico.
     """
+
+
+def conta_token(m, risposta):
+    """Token di prompt e risposta dai metadati d'uso di Gemini (se presenti)"""
+    uso = getattr(risposta, "usage_metadata", None)
+    if uso is None:
+        return
+    m.conta("gemini_token", getattr(uso, "prompt_token_count", 0) or 0, tipo="prompt")
+    m.conta("gemini_token", getattr(uso, "candidates_token_count", 0) or 0, tipo="risposta")
+
+
+def genera_piano_nutrizionale(testo_input, stile_studio, obiettivo_cliente, dati_fisici, allegati=()):
+    """allegati: parti multimodali ({"mime_type", "data"}) mandate insieme al prompt"""
+    try:
+        model = gemini().GenerativeModel(MODELLO_GEMINI)
+    except Exception as e:
+        return f"Errore generazione AI (configurazione Gemini): {e}"
+    prompt = componi_prompt(testo_input, stile_studio, obiettivo_cliente, dati_fisici)
+    m = metriche()
     
     try:
-        response = model.generate_content(prompt)
+        with m.span("gemini", modalita="singola"):
+            response = resilienza("gemini").esegui(
+                lambda: model.generate_content([prompt, *allegati] if allegati else prompt), "singola"
+            )
+        conta_token(m, response)
         return response.text
     except Exception as e:
         return f"Errore generazione AI: {e}"
 
+
+def genera_piano_streaming(testo_input, stile_studio, obiettivo_cliente, dati_fisici, allegati=()):
+    """Come genera_piano_nutrizionale, ma restituisce il testo a pezzi man mano che arriva.
+
+    Modello, metriche e resilienza si leggono subito, nel thread dello script:
+    il generatore restituito si può consumare anche da un altro thread.
+    """
+    try:
+        model = gemini().GenerativeModel(MODELLO_GEMINI)
+    except Exception as e:
+        return _solo_messaggio(f"Errore generazione AI (configurazione Gemini): {e}")
+    prompt = componi_prompt(testo_input, stile_studio, obiettivo_cliente, dati_fisici)
+    return _flusso_piano(model, [prompt, *allegati] if allegati else prompt, metriche(), resilienza("gemini"))
+
+
+def _solo_messaggio(testo):
+    # Generatore e non lista: chi consuma il flusso lo chiude con close()
+    yield testo
+
+
+def _flusso_piano(model, contenuto, m, res):
+    inizio = time.perf_counter()
+    ultimo = None
+
+    def apri():
+        # Si riprova solo finché non è arrivato niente: dopo, il testo sarebbe doppio
+        flusso = iter(model.generate_content(contenuto, stream=True))
+        return flusso, next(flusso, None)
+    
+    try:
+        with m.span("gemini", modalita="streaming"):
+            flusso, primo = res.esegui(apri, "streaming")
+            for chunk in itertools.chain([] if primo is None else [primo], flusso):
+                if ultimo is None:
+                    m.osserva("gemini_primo_pezzo", time.perf_counter() - inizio)
+                ultimo = chunk
+                try:
+                    pezzo = chunk.text
+                except ValueError:
+                    continue # Chunk senza testo (es. solo metadati di sicurezza)
+                if pezzo:
+                    yield pezzo
+        # I metadati d'uso completi arrivano con l'ultimo chunk
+        conta_token(m, ultimo)
+    except Exception as e:
+        yield f"\n\nErrore generazione AI: {e}"
+
+
+class GenerazioneStreaming:
+    """Consuma in un thread il flusso di genera_piano_streaming, così si può interrompere.
+
+    Un rerun di fragment non interrompe lo script: il pulsante di stop alza
+    un flag, controllato a ogni pezzo che arriva, e la UI rilegge il testo
+    a intervalli (frammento con run_every). Il thread non chiama funzioni st.*.
+    """
+
+    def __init__(self, flusso, chiave_piano=None):
+        self.chiave_piano = chiave_piano # Per salvare in CachePiani il piano completo
+        self.interrotta = False
+        self._testo = ""
+        self._primo_testo = None
+        self._inizio = time.perf_counter()
+        self._fine = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._consuma, args=(flusso,), name="generazione-piano", daemon=True).start()
+
+    def _consuma(self, flusso):
+        try:
+            for pezzo in flusso:
+                if self._stop.is_set():
+                    break
+                with self._lock:
+                    if self._primo_testo is None:
+                        self._primo_testo = time.perf_counter() - self._inizio
+                    self._testo += pezzo
+        finally:
+            flusso.close() # Chiude anche la risposta HTTP di Gemini
+            with self._lock:
+                if self._fine is None:
+                    self._fine = time.perf_counter()
+
+    def ferma(self):
+        """Interrompe subito: il testo arrivato finora resta, il resto si scarta"""
+        self._stop.set()
+        with self._lock:
+            self.interrotta = True
+            if self._fine is None:
+                self._fine = time.perf_counter()
+
+    def stato(self):
+        """(testo finora, secondi al primo testo, secondi totali, finita)"""
+        with self._lock:
+            fine = self._fine if self._fine is not None else time.perf_counter()
+            return self._testo, self._primo_testo, fine - self._inizio, self._fine is not None
+
+
+class CachePiani:
+    """Piani già generati, indicizzati per hash di modello + prompt normalizzato.
+
+    LRU in memoria davanti a una cartella su disco (un file per piano); quando
+    la cartella supera max_mb si cancellano i file usati meno di recente.
+    """
+
+    def __init__(self, cartella, max_memoria=128, max_mb=50):
+        self.cartella = cartella
+        self.max_memoria = max_memoria
+        self.max_byte = max_mb * 1024 * 1024
+        self.hit = 0
+        self.miss = 0
+        self._memoria = OrderedDict()  # chiave -> testo
+        self._lock = threading.Lock()
+        os.makedirs(cartella, exist_ok=True)
+
+    @staticmethod
+    def chiave(prompt, modello):
+        # Spazi e a capo non cambiano il significato del prompt
+        normalizzato = " ".join(prompt.split())
+        return hashlib.sha256(f"{modello}\n{normalizzato}".encode("utf-8")).hexdigest()
+
+    def _percorso(self, chiave):
+        return os.path.join(self.cartella, f"{chiave}.txt")
+
+    def leggi(self, chiave):
+        with self._lock:
+            testo = self._memoria.get(chiave)
+            if testo is not None:
+                self._memoria.move_to_end(chiave)
+                self.hit += 1
+                return testo
+        try:
+            with open(self._percorso(chiave), encoding="utf-8") as f:
+                testo = f.read()
+            os.utime(self._percorso(chiave)) # Segna come usato di recente
+        except FileNotFoundError:
+            with self._lock:
+                self.miss += 1
+            return None
+        with self._lock:
+            self.hit += 1
+            self._ricorda(chiave, testo)
+        return testo
+
+    def salva(self, chiave, testo):
+        percorso = self._percorso(chiave)
+        with open(percorso + ".tmp", "w", encoding="utf-8") as f:
+            f.write(testo)
+        os.replace(percorso + ".tmp", percorso)
+        with self._lock:
+            self._ricorda(chiave, testo)
+        self._libera_disco()
+
+    def _ricorda(self, chiave, testo):
+        self._memoria[chiave] = testo
+        self._memoria.move_to_end(chiave)
+        while len(self._memoria) > self.max_memoria:
+            self._memoria.popitem(last=False)
+
+    def _libera_disco(self):
+        voci = []
+        for nome in os.listdir(self.cartella):
+            if nome.endswith(".txt"):
+                info = os.stat(os.path.join(self.cartella, nome))
+                voci.append((info.st_mtime, info.st_size, nome))
+        totale = sum(v[1] for v in voci)
+        for _, dimensione, nome in sorted(voci):
+            if totale <= self.max_byte:
+                break
+            try:
+                os.remove(os.path.join(self.cartella, nome))
+            except FileNotFoundError:
+                pass
+            totale -= dimensione
+
+    def statistiche(self):
+        with self._lock:
+            totale = self.hit + self.miss
+            return {"hit": self.hit, "miss": self.miss, "percentuale_hit": (100 * self.hit / totale) if totale else 0.0}
+
+
+@st.cache_resource
+def cache_piani():
+    """CachePiani del processo, o None se non attivata ([cache_piani] attiva = true)"""
+    cfg = st.secrets.get("cache_piani", {})
+    if not cfg.get("attiva", False):
+        return None
+    return CachePiani(
+        cartella=cfg.get("cartella", ".cache_piani"),
+        max_memoria=int(cfg.get("max_memoria", 128)),
+        max_mb=float(cfg.get("max_mb", 50)),
+    )
+
+
+def streaming_attivo():
+    """Streaming della risposta Gemini, attivo salvo [gemini] streaming = false"""
+    return bool(st.secrets.get("gemini", {}).get("streaming", True))
+
+@st.cache_resource
+def limitatore_gemini():
+    """Limite condiviso da tutte le sessioni ([gemini] richieste_al_minuto)"""
+    cfg = st.secrets.get("gemini", {})
+    return LimitatoreRichieste(int(cfg.get("richieste_al_minuto", 60)), int(cfg.get("picco", 5)))
+
+
+def _genera_con_tentativi(model, prompt, res, tentativi=3):
+    """Chiamata a Gemini con il budget e i nuovi tentativi di resilienza("gemini")"""
+    with res.metriche.span("gemini", modalita="blocco"):
+        risposta = res.esegui(lambda: model.generate_content(prompt), "blocco", tentativi=tentativi)
+    conta_token(res.metriche, risposta)
+    return risposta.text
+
+
+def genera_piani_in_blocco(richieste, max_thread=None, tentativi=3):
+    """Genera più piani in parallelo su un pool di thread limitato.
+
+    richieste: {username: prompt}. Restituisce un generatore di
+    (username, testo, errore) nell'ordine in cui le risposte arrivano, così
+    la UI può aggiornare l'avanzamento. Non chiama funzioni st.* dai thread.
+    max_thread di default da [gemini] thread_blocco (8). Se il generatore
+    viene chiuso a metà (rerun durante il blocco) le chiamate non ancora
+    partite si annullano e non si aspettano quelle in corso.
+    """
+    # Letti qui: i thread non hanno il contesto dello script
+    res = resilienza("gemini")
+    if max_thread is None:
+        max_thread = int(st.secrets.get("gemini", {}).get("thread_blocco", 8))
+    try:
+        model = gemini().GenerativeModel(MODELLO_GEMINI)
+    except Exception as e:
+        for username in richieste:
+            yield username, None, f"Errore configurazione Gemini: {e}"
+        return
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_thread, len(richieste))), thread_name_prefix="blocco")
+    try:
+        futuri = {
+            pool.submit(_genera_con_tentativi, model, prompt, res, tentativi): username
+            for username, prompt in richieste.items()
+        }
+        for futuro in as_completed(futuri):
+            username = futuri[futuro]
+            try:
+                yield username, futuro.result(), None
+            except Exception as e:
+                yield username, None, str(e)
+    finally:
+        # Non "with": la sua shutdown(wait=True) farebbe partire tutte le chiamate in
+        # coda e bloccherebbe il rerun fino all'ultima, buttando i risultati
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# ==========================================
+# PIANI STRUTTURATI (JSON compatto e revisioni come differenze)
+# ==========================================
+# Giorni -> pasti -> alimenti con porzione. Con [gemini] piano_strutturato = true
+# Gemini risponde con questo schema e in testo_dieta si salva JSON compatto:
+#   {"v":1,"piano":{...}}                            piano intero
+#   {"v":1,"base":"<impronta>","n":k,"diff":{...}}   solo i pasti cambiati rispetto al
+#                                                    piano precedente dello stesso cliente
+# I piani in testo libero (markdown) restano leggibili come prima.
+SCHEMA_PIANO = {
+    "type": "object",
+    "properties": {
+        "giorni": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "giorno": {"type": "string"},
+                    "pasti": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "nome": {"type": "string"},
+                                "alimenti": {
+                                    "type": "array",
+                                    "items": {
+                                        "type": "object",
+                                        "properties": {
+                                            "alimento": {"type": "string"},
+                                            "porzione": {"type": "string"},
+                                        },
+                                        "required": ["alimento", "porzione"],
+                                    },
+                                },
+                            },
+                            "required": ["nome", "alimenti"],
+                        },
+                    },
+                },
+                "required": ["giorno", "pasti"],
+            },
+        },
+        "note": {"type": "string"},
+    },
+    "required": ["giorni"],
+}
+
+# Dopo tante differenze di fila si salva di nuovo il piano intero: così per
+# ricostruire un piano bastano poche righe dello storico
+MAX_CATENA_DIFF = 5
+
+
+def piano_strutturato_attivo():
+    """Piani in JSON strutturato ([gemini] piano_strutturato = true), spento di default"""
+    return bool(st.secrets.get("gemini", {}).get("piano_strutturato", False))
+
+
+def genera_piano_strutturato(testo_input, stile_studio, obiettivo_cliente, dati_fisici, allegati=()):
+    """Piano secondo SCHEMA_PIANO: (dict, None) oppure (None, messaggio di errore)"""
+    try:
+        model = gemini().GenerativeModel(
+            MODELLO_GEMINI,
+            generation_config={"response_mime_type": "application/json", "response_schema": SCHEMA_PIANO},
+        )
+    except Exception as e:
+        return None, f"Errore generazione AI (configurazione Gemini): {e}"
+    prompt = componi_prompt(testo_input, stile_studio, obiettivo_cliente, dati_fisici)
+    m = metriche()
+    
+    try:
+        with m.span("gemini", modalita="strutturata"):
+            response = resilienza("gemini").esegui(
+                lambda: model.generate_content([prompt, *allegati] if allegati else prompt), "strutturata"
+            )
+        conta_token(m, response)
+        return json.loads(response.text), None
+    except Exception as e:
+        return None, f"Errore generazione AI: {e}"
+
+
+def json_compatto(dato, ordina=False):
+    return json.dumps(dato, ensure_ascii=False, separators=(",", ":"), sort_keys=ordina)
+
+
+def impronta_piano(piano):
+    return hashlib.sha256(json_compatto(piano, ordina=True).encode("utf-8")).hexdigest()[:12]
+
+
+def _chiave_pasto(giorno, nome, volta=1):
+    # Lo stesso pasto due volte nello stesso giorno (es. due "Spuntino"):
+    # dalla seconda la chiave ha il numero, la prima resta com'era
+    return f"{giorno}\t{nome}" if volta == 1 else f"{giorno}\t{nome}\t{volta}"
+
+
+def _pasti(piano):
+    """{"giorno\tpasto": [[alimento, porzione], ...]} nell'ordine del piano"""
+    pasti = {}
+    for giorno in piano.get("giorni", []):
+        for pasto in giorno.get("pasti", []):
+            volta = 1
+            while _chiave_pasto(giorno.get("giorno", ""), pasto.get("nome", ""), volta) in pasti:
+                volta += 1
+            pasti[_chiave_pasto(giorno.get("giorno", ""), pasto.get("nome", ""), volta)] = [
+                [a.get("alimento", ""), a.get("porzione", "")] for a in pasto.get("alimenti", [])
+            ]
+    return pasti
+
+
+def _da_pasti(pasti, note):
+    giorni = {}
+    for chiave, alimenti in pasti.items():
+        giorno, nome = chiave.split("\t")[:2]
+        giorni.setdefault(giorno, []).append({
+            "nome": nome,
+            "alimenti": [{"alimento": a, "porzione": p} for a, p in alimenti],
+        })
+    piano = {"giorni": [{"giorno": g, "pasti": p} for g, p in giorni.items()]}
+    if note:
+        piano["note"] = note
+    return piano
+
+
+def differenza_piani(vecchio, nuovo):
+    """Solo i pasti cambiati (None = pasto tolto), più ordine e note se cambiano"""
+    pv, pn = _pasti(vecchio), _pasti(nuovo)
+    diff = {"pasti": {k: v for k, v in pn.items() if pv.get(k) != v}}
+    diff["pasti"].update({k: None for k in pv if k not in pn})
+    # L'ordine serve solo se applicando la differenza non viene già giusto
+    if [k for k in pv if k in pn] + [k for k in pn if k not in pv] != list(pn):
+        diff["ordine"] = list(pn)
+    if vecchio.get("note", "") != nuovo.get("note", ""):
+        diff["note"] = nuovo.get("note", "")
+    return diff
+
+
+def applica_differenza(vecchio, diff):
+    pasti = _pasti(vecchio)
+    for chiave, alimenti in diff["pasti"].items():
+        if alimenti is None:
+            pasti.pop(chiave, None)
+        else:
+            pasti[chiave] = alimenti
+    ordine = diff.get("ordine", list(pasti))
+    return _da_pasti({k: pasti[k] for k in ordine if k in pasti}, diff.get("note", vecchio.get("note", "")))
+
+
+def codifica_piano(piano, precedente=None, catena=0):
+    """Testo per testo_dieta: la differenza dal piano precedente se è più corta, altrimenti il piano intero"""
+    intero = json_compatto({"v": 1, "piano": piano})
+    if precedente is None or catena >= MAX_CATENA_DIFF:
+        return intero
+    differenza = differenza_piani(precedente, piano)
+    # Prova di andata e ritorno: se dalla differenza non torna lo stesso piano
+    # (es. un caso che _pasti non distingue) si salva il piano intero
+    if impronta_piano(applica_differenza(precedente, differenza)) != impronta_piano(piano):
+        return intero
+    diff = json_compatto({
+        "v": 1, "base": impronta_piano(precedente), "n": catena + 1,
+        "diff": differenza,
+    })
+    return diff if len(diff) < len(intero) else intero
+
+
+def decodifica_piano(testo):
+    """("testo", markdown) per i piani liberi, ("piano", dict) o ("diff", dict)"""
+    testo = testo_cella(testo)
+    if testo.startswith("{"):
+        try:
+            dato = json.loads(testo)
+        except ValueError:
+            return "testo", testo
+        if isinstance(dato, dict) and dato.get("v") == 1:
+            if "piano" in dato:
+                return "piano", dato["piano"]
+            if "diff" in dato:
+                return "diff", dato
+    return "testo", testo
+
+
+def ricostruisci_piani(voci):
+    """Piani (dict) delle voci decodificate, dalla più recente; None per testi liberi o basi mancanti"""
+    piani = [None] * len(voci)
+    impronte = [None] * len(voci)
+    # Dalla più vecchia: la base di una differenza è sempre più indietro nello storico
+    for i in range(len(voci) - 1, -1, -1):
+        tipo, dato = voci[i]
+        if tipo == "piano":
+            piani[i] = dato
+        elif tipo == "diff":
+            base = next((j for j in range(i + 1, len(voci)) if impronte[j] == dato["base"]), None)
+            if base is not None:
+                piani[i] = applica_differenza(piani[base], dato["diff"])
+        if piani[i] is not None:
+            impronte[i] = impronta_piano(piani[i])
+    return piani
+
+
+def piano_in_markdown(piano):
+    righe = []
+    for giorno in piano.get("giorni", []):
+        righe.append(f"### {giorno.get('giorno', '')}")
+        for pasto in giorno.get("pasti", []):
+            alimenti = ", ".join(
+                f"{a.get('alimento', '')} ({a['porzione']})" if a.get("porzione") else a.get("alimento", "")
+                for a in pasto.get("alimenti", [])
+            )
+            righe.append(f"- **{pasto.get('nome', '')}**: {alimenti}")
+    if piano.get("note"):
+        righe.append(f"\n{piano['note']}")
+    return "\n".join(righe)
+
+
+def piano_in_tabella(piano):
+    """Una riga per alimento (giorno, pasto, alimento, porzione): per la revisione con data_editor.
+
+    Un pasto ripetuto nello stesso giorno compare come "Spuntino (2)"; un pasto
+    senza alimenti ha una riga con l'alimento vuoto.
+    """
+    righe = []
+    for chiave, alimenti in _pasti(piano).items():
+        giorno, nome, *volta = chiave.split("\t")
+        pasto = f"{nome} ({volta[0]})" if volta else nome
+        for a, p in alimenti or [["", ""]]:
+            righe.append({"giorno": giorno, "pasto": pasto, "alimento": a, "porzione": p})
+    return pd.DataFrame(righe, columns=["giorno", "pasto", "alimento", "porzione"])
+
+
+def piano_da_tabella(tabella, note=""):
+    tabella = tabella.fillna("")
+    tabella = tabella[(tabella["giorno"].str.strip() != "") & (
+        (tabella["alimento"].str.strip() != "") | (tabella["pasto"].str.strip() != "")
+    )]
+    pasti = {}
+    for riga in tabella.itertuples(index=False):
+        pasto = riga.pasto.strip()
+        ripetuto = re.fullmatch(r"(.*) \((\d+)\)", pasto)
+        if ripetuto and int(ripetuto.group(2)) > 1:
+            chiave = _chiave_pasto(riga.giorno.strip(), ripetuto.group(1), int(ripetuto.group(2)))
+        else:
+            chiave = _chiave_pasto(riga.giorno.strip(), pasto)
+        alimenti = pasti.setdefault(chiave, [])
+        if riga.alimento.strip():
+            alimenti.append([riga.alimento.strip(), riga.porzione.strip()])
+    return _da_pasti(pasti, note)
+
+
+def piano_precedente(cliente):
+    """(piano, lunghezza della catena di differenze) dell'ultimo piano del cliente, o (None, 0)"""
+    righe, _ = storico_piani(cliente, salta=0, limite=2 * MAX_CATENA_DIFF + 1)
+    voci = [decodifica_piano(t) for t in righe['testo_dieta']] if 'testo_dieta' in righe.columns else []
+    if not voci:
+        return None, 0
+    tipo, dato = voci[0]
+    return ricostruisci_piani(voci)[0], (dato.get("n", 0) if tipo == "diff" else 0)
+
+
+def testi_piani(cliente, testi, salta):
+    """Markdown da mostrare per i piani `testi` (storico del cliente a partire da `salta`).
+
+    Per le differenze servono anche i piani precedenti: si legge al massimo
+    una finestra di righe in più dallo storico.
+    """
+    voci = [decodifica_piano(t) for t in testi]
+    if any(tipo == "diff" for tipo, _ in voci):
+        altre, _ = storico_piani(cliente, salta=salta + len(voci), limite=2 * MAX_CATENA_DIFF + 1)
+        voci += [decodifica_piano(t) for t in altre['testo_dieta']] if 'testo_dieta' in altre.columns else []
+    piani = ricostruisci_piani(voci)
+    risultato = []
+    for (tipo, dato), piano in zip(voci[:len(testi)], piani):
+        if piano is not None:
+            risultato.append(piano_in_markdown(piano))
+        elif tipo == "testo":
+            risultato.append(dato)
+        else:
+            risultato.append("⚠️ Revisione non ricostruibile: piano di partenza non trovato nello storico.")
+    return risultato
+
+# ==========================================
+# REFERTI (contenuto dei file caricati)
+# ==========================================
+class EstrattoreReferti:
+    """Estrae il contenuto dei referti in thread separati, una volta sola per contenuto.
+
+    PDF -> testo, pagina per pagina, fino a max_pagine / max_caratteri (oltre
+    si tronca). Se il PDF non ha testo (scansione) o manca pypdf, il PDF va a
+    Gemini come parte multimodale. Immagini -> parte multimodale JPEG, con il
+    lato lungo ridotto a lato_immagine. I risultati sono indicizzati per
+    SHA-256 del file: ricaricare lo stesso referto non costa nulla.
+    """
+
+    def __init__(self, max_caratteri=20000, max_pagine=50, lato_immagine=1600, max_voci=64, max_thread=2):
+        self.max_caratteri = max_caratteri
+        self.max_pagine = max_pagine
+        self.lato_immagine = lato_immagine
+        self.max_voci = max_voci
+        self._pool = ThreadPoolExecutor(max_workers=max_thread, thread_name_prefix="referti")
+        self._voci = OrderedDict()  # sha256 -> Future del risultato
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def impronta(file):
+        """SHA-256 del file caricato, letto a blocchi da 1 MB senza copiarlo"""
+        h = hashlib.sha256()
+        with file.getbuffer() as vista:
+            for inizio in range(0, len(vista), 1 << 20):
+                h.update(vista[inizio:inizio + (1 << 20)])
+        return h.hexdigest()
+
+    def avvia(self, file):
+        """Avvia l'estrazione (se non già fatta) e restituisce la chiave per risultato()"""
+        chiave = self.impronta(file)
+        with self._lock:
+            if chiave in self._voci:
+                self._voci.move_to_end(chiave)
+                return chiave
+            # getvalue() non copia i dati: condivide il buffer del file caricato
+            self._voci[chiave] = self._pool.submit(self._estrai, file.name, file.getvalue())
+            while len(self._voci) > self.max_voci:
+                self._voci.popitem(last=False)
+        return chiave
+
+    def risultato(self, chiave):
+        """{"testo", "parti", "avvisi"} del referto (aspetta se l'estrazione è in corso)"""
+        with self._lock:
+            futuro = self._voci.get(chiave)
+        if futuro is None:
+            return {"testo": "", "parti": [], "avvisi": ["Referto non più in memoria, ricaricalo."]}
+        return futuro.result()
+
+    def _estrai(self, nome, dati):
+        try:
+            if nome.lower().endswith(".pdf"):
+                return self._estrai_pdf(dati)
+            return self._estrai_immagine(dati)
+        except Exception as e:
+            return {"testo": "", "parti": [], "avvisi": [f"Referto {nome} non leggibile: {e}"]}
+
+    def _estrai_pdf(self, dati):
+        avvisi = []
+        pezzi = []
+        caratteri = 0
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            PdfReader = None # Opzionale: senza pypdf i PDF si mandano a Gemini così come sono
+        if PdfReader is not None:
+            lettore = PdfReader(io.BytesIO(dati))
+            if lettore.is_encrypted:
+                lettore.decrypt("")
+            for numero, pagina in enumerate(lettore.pages):
+                if numero >= self.max_pagine:
+                    avvisi.append(f"Lette solo le prime {self.max_pagine} pagine su {len(lettore.pages)}.")
+                    break
+                testo = (pagina.extract_text() or "").strip()
+                if caratteri + len(testo) > self.max_caratteri:
+                    pezzi.append(testo[:self.max_caratteri - caratteri])
+                    avvisi.append(f"Testo del referto troncato a {self.max_caratteri} caratteri.")
+                    break
+                pezzi.append(testo)
+                caratteri += len(testo)
+        testo = "\n".join(p for p in pezzi if p)
+        if testo:
+            return {"testo": testo, "parti": [], "avvisi": avvisi}
+        # Scansione senza testo (o pypdf mancante): legge Gemini
+        return {"testo": "", "parti": [{"mime_type": "application/pdf", "data": dati}], "avvisi": avvisi}
+
+    def _estrai_immagine(self, dati):
+        from PIL import Image # Già installata con streamlit
+        immagine = Image.open(io.BytesIO(dati))
+        immagine.thumbnail((self.lato_immagine, self.lato_immagine))
+        uscita = io.BytesIO()
+        immagine.convert("RGB").save(uscita, format="JPEG", quality=85)
+        return {"testo": "", "parti": [{"mime_type": "image/jpeg", "data": uscita.getvalue()}], "avvisi": []}
+
+
+@st.cache_resource
+def estrattore_referti():
+    """Estrattore del processo, configurabile da secrets.toml ([referti])"""
+    cfg = st.secrets.get("referti", {})
+    return EstrattoreReferti(
+        max_caratteri=int(cfg.get("max_caratteri", 20000)),
+        max_pagine=int(cfg.get("max_pagine", 50)),
+        lato_immagine=int(cfg.get("lato_immagine", 1600)),
+    )
+
+
+def avvia_referto(file):
+    """Chiave dell'estrazione del file caricato (avviata una volta per file), o None se troppo grande"""
+    max_mb = float(st.secrets.get("referti", {}).get("max_mb", 15))
+    if file.size > max_mb * 1024 * 1024:
+        st.warning(f"Referto troppo grande ({file.size / 1024 / 1024:.1f} MB, massimo {max_mb:.0f} MB): verrà usato solo il nome.")
+        return None
+    # Il fragment si riesegue a ogni click: l'hash si calcola una volta per file
+    precedente = st.session_state.get("referto")
+    if precedente is not None and precedente[0] == file.file_id:
+        return precedente[1]
+    chiave = estrattore_referti().avvia(file)
+    st.session_state.referto = (file.file_id, chiave)
+    return chiave
+
 # ==========================================
 # GESTIONE LOGIN E STATO
 # ==========================================
@@ -159,22 +2643,14 @@ def login_page():
             btn = st.form_submit_button("Entra come Studio")
             
             if btn:
-                df = leggi_tab("CONFIG_STUDI")
+                studi = rubrica("CONFIG_STUDI")
                 
-                if df.empty:
+                if studi.vuota:
                     st.error("Database non raggiungibile o vuoto.")
                 else:
-                    # --- PULIZIA SPECIALE PER LOGIN ---
-                    # 1. Assicuriamoci che i nomi colonne siano minuscoli e senza spazi
-                    df.columns = df.columns.str.lower().str.strip()
-                    
-                    # 2. Convertiamo i dati in stringa
-                    df['username'] = df['username'].astype(str).str.strip()
-                    df['password'] = df['password'].astype(str).str.strip()
-                    
-                    # 3. TRUCCO FONDAMENTALE: Rimuovi ".0" se presente alla fine della password
-                    # (Questo risolve il problema 1234 diventa 1234.0)
-                    df['password'] = df['password'].str.replace(r'\.0$', '', regex=True)
+                    # La pulizia (minuscole, spazi, ".0" nelle password) è già
+                    # fatta una volta sola da RubricaUtenti
+                    df = studi.df
 
                     # --- DEBUG VISIVO (Così vedi coi tuoi occhi) ---
                     st.write("🔍 Confronto Dati:")
@@ -183,31 +2659,21 @@ def login_page():
                     st.dataframe(df[['username', 'password']].head())
                     # ---------------------------------------------
 
-                    # 4. IL CONTROLLO
-                    # Usiamo .str.lower() per ignorare maiuscole/minuscole nello username
-                    check = df[
-                        (df['username'].str.lower() == user.strip().lower()) & 
-                        (df['password'] == pwd.strip())
-                    ]
+                    # IL CONTROLLO (username senza distinzione maiuscole/minuscole)
+                    dati_utente = studi.verifica(user, pwd)
                     
-                    if not check.empty:
-                        dati_utente = check.iloc[0]
-                        
+                    if dati_utente is not None:
                         # --- CONTROLLO 3 GIORNI (Formato Italiano) ---
                         try:
                             # Cerchiamo la colonna data, gestendo nomi diversi
                             col_data = 'data_iscrizione' if 'data_iscrizione' in df.columns else 'data'
                             col_paga = 'pagato'
                             
-                            data_str = str(dati_utente.get(col_data, ''))
-                            pagato = str(dati_utente.get(col_paga, 'NO')).upper().strip()
+                            d_inizio = dati_utente.get(col_data)
+                            pagato = testo_cella(dati_utente.get(col_paga), 'NO').upper().strip()
                             
-                            if len(data_str) >= 8:
-                                try:
-                                    d_inizio = datetime.strptime(data_str, "%d/%m/%Y")
-                                except:
-                                    d_inizio = datetime.strptime(data_str, "%d-%m-%Y")
-                                
+                            # La data è già convertita da normalizza_df (NaT se vuota)
+                            if d_inizio is not None and not pd.isna(d_inizio):
                                 giorni = (datetime.now() - d_inizio).days
                                 if giorni > 3 and pagato != "SI":
                                     st.error(f"⛔ Prova scaduta da {giorni-3} giorni.")
@@ -215,7 +2681,9 @@ def login_page():
                         except Exception as e:
                             print(f"Salto controllo data: {e}")
 
-                        # LOGIN OK
+                        # LOGIN OK: i fogli della dashboard si leggono in parallelo
+                        # mentre parte il rerun
+                        precarica(st.secrets.get("cache", {}).get("precarica_studio", ["CLIENTI"]))
                         st.session_state.logged_in = True
                         st.session_state.role = "studio"
                         st.session_state.user_data = dati_utente
@@ -231,19 +2699,18 @@ def login_page():
             btn_c = st.form_submit_button("Entra come Cliente")
             
             if btn_c:
-                df = leggi_tab("CLIENTI")
-                if df.empty:
+                # Lo studio del cliente si legge intanto che si verifica CLIENTI
+                precarica(["CLIENTI", "CONFIG_STUDI"])
+                clienti = rubrica("CLIENTI")
+                if clienti.vuota:
                     st.error("Database Clienti vuoto.")
                 else:
-                    df['username'] = df['username'].astype(str).str.strip()
-                    df['password'] = df['password'].astype(str).str.strip()
-                    
-                    check = df[(df['username'] == user_c) & (df['password'] == pwd_c)]
-                    if not check.empty:
+                    cliente = clienti.verifica(user_c, pwd_c, ignora_maiuscole=False)
+                    if cliente is not None:
                         st.session_state.logged_in = True
                         st.session_state.role = "cliente"
-                        st.session_state.user_data = check.iloc[0]
-                        st.session_state.linked_studio = get_studio_info(check.iloc[0]['studio_riferimento'])
+                        st.session_state.user_data = cliente
+                        st.session_state.linked_studio = get_studio_info(cliente['studio_riferimento'])
                         st.rerun()
                     else:
                         st.error("Credenziali errate.")
@@ -252,6 +2719,7 @@ def logout():
     st.session_state.logged_in = False
     st.session_state.role = None
     st.session_state.user_data = None
+    st.session_state.pagina_storico = 0
     st.rerun()
 
 # ==========================================
@@ -261,272 +2729,569 @@ def dashboard_studio():
     dati = st.session_state.user_data
     
     with st.sidebar:
-        logo_url = str(dati.get('logo_url', ''))
+        logo_url = testo_cella(dati.get('logo_url'))
         # CORREZIONE WARNING: cambiato use_column_width in use_container_width
-        if logo_url and logo_url.lower() != "nan":
+        if logo_url:
             st.image(logo_url, use_container_width=True) 
         
         st.title(f"{dati['nome_studio']}")
+        coda = coda_scritture()
+        if coda is not None and coda.in_coda():
+            st.caption(f"⏳ {coda.in_coda()} salvataggi in coda")
+        stato_sync()
+        piani = cache_piani()
+        if piani is not None:
+            stat = piani.statistiche()
+            st.caption(f"♻️ Cache piani: {stat['hit']} hit / {stat['miss']} miss ({stat['percentuale_hit']:.0f}%)")
+        pannello_metriche(dati)
         if st.button("Esci"): logout()
 
     st.subheader(f"Gestione Pazienti - {dati['nome_studio']}")
     
-    tabs = st.tabs(["📝 Genera Piano", "👥 Gestione Clienti", "⚙️ Impostazioni"])
+    # Tab "pigre": si costruisce solo quella aperta, e ognuna è un fragment
+    # che si riesegue da solo (un click in una tab non ricarica le altre)
+    tabs = st.tabs(["📝 Genera Piano", "👥 Gestione Clienti", "⚙️ Impostazioni"], key="tab_studio", on_change="rerun")
 
-    # TAB 1: GENERATORE
     with tabs[0]:
-        df_clienti = leggi_tab("CLIENTI")
-        miei_clienti = df_clienti[df_clienti['studio_riferimento'] == dati['username']]
+        if tabs[0].open:
+            tab_genera_piano(dati)
+    with tabs[1]:
+        if tabs[1].open:
+            tab_gestione_clienti(dati)
+    with tabs[2]:
+        if tabs[2].open:
+            tab_impostazioni(dati)
+
+
+def pannello_metriche(dati):
+    """Pannello admin nella sidebar ([metriche] pannello = true, admin = lista di studi)"""
+    cfg = st.secrets.get("metriche", {})
+    ammessi = cfg.get("admin", [])
+    if not cfg.get("pannello", False) or (ammessi and dati['username'] not in ammessi):
+        return
+    with st.expander("📊 Metriche"):
+        m = metriche()
+        dati_metriche = m.istantanea()
+        if dati_metriche["tempi"]:
+            st.dataframe(pd.DataFrame(dati_metriche["tempi"]), hide_index=True)
+        if dati_metriche["contatori"]:
+            st.dataframe(pd.DataFrame(dati_metriche["contatori"]), hide_index=True)
+        if dati_metriche["valori"]:
+            st.dataframe(pd.DataFrame(dati_metriche["valori"]), hide_index=True)
+        avvio = tempi_avvio().rapporto()
+        if avvio:
+            st.caption(f"⏱️ Avvio: {avvio}")
+        st.download_button("⬇️ Prometheus", m.prometheus(), file_name="metriche.prom", mime="text/plain")
+        st.download_button(
+            "⬇️ JSON", json.dumps(dati_metriche, ensure_ascii=False, default=str),
+            file_name="metriche.json", mime="application/json",
+        )
+
+
+# TAB 1: GENERATORE
+@st.fragment
+@misurato("frammento", funzione="tab_genera_piano")
+def tab_genera_piano(dati):
+    clienti = rubrica("CLIENTI")
+    miei_clienti = clienti.clienti_di(dati['username'])
+    
+    if miei_clienti.empty:
+        st.warning("Nessun cliente trovato.")
+    else:
+        col_sel, col_info = st.columns([1, 2], gap="medium")
         
-        if miei_clienti.empty:
-            st.warning("Nessun cliente trovato.")
-        else:
-            col_sel, col_info = st.columns([1, 2], gap="medium")
-            
-            with col_sel:
-                cliente_sel = st.selectbox("👤 Seleziona Paziente:", miei_clienti['username'].tolist())
-            
-            # Recupera dati aggiornati
-            paziente_row = miei_clienti[miei_clienti['username'] == cliente_sel].iloc[0]
-            fisico = str(paziente_row.get('dati_fisici', '-'))
-            obiettivo = str(paziente_row.get('obiettivo_specifico', 'Standard'))
-            
-            # Gestione dati mancanti per la visualizzazione
-            email_db = str(paziente_row.get('email', ''))
-            if email_db == "nan": email_db = ""
-            
-            tel_db = str(paziente_row.get('telefono', ''))
-            if tel_db == "nan": tel_db = ""
+        with col_sel:
+            cliente_sel = st.selectbox("👤 Seleziona Paziente:", miei_clienti['username'].tolist())
+        
+        # Recupera dati aggiornati
+        paziente_row = clienti.cliente_di(dati['username'], cliente_sel)
+        fisico = testo_cella(paziente_row.get('dati_fisici'), '-')
+        obiettivo = testo_cella(paziente_row.get('obiettivo_specifico'), 'Standard')
+        
+        # Dati mancanti = stringa vuota (le celle vuote sono già <NA>)
+        email_db = testo_cella(paziente_row.get('email'))
+        tel_db = testo_cella(paziente_row.get('telefono'))
 
-            with col_info:
-                with st.container(border=True):
-                    st.markdown(f"🎯 **Obiettivo:** {obiettivo}")
-                    st.caption(f"📏 {fisico} | 📞 {tel_db if tel_db else 'No Tel'} | 📧 {email_db if email_db else 'No Mail'}")
+        with col_info:
+            with st.container(border=True):
+                st.markdown(f"🎯 **Obiettivo:** {obiettivo}")
+                st.caption(f"📏 {fisico} | 📞 {tel_db if tel_db else 'No Tel'} | 📧 {email_db if email_db else 'No Mail'}")
 
-            st.write("---")
-            
-            # INPUT DATI
-            col1, col2 = st.columns(2)
-            testo_ai = ""
-            
-            with col1:
-                uploaded_file = st.file_uploader("📂 Carica Referto", type=['pdf', 'png', 'jpg'])
-            with col2:
-                note_manuali = st.text_area("📝 Note / Sintomi", height=100)
+        st.write("---")
+        
+        # INPUT DATI
+        col1, col2 = st.columns(2)
+        testo_ai = ""
+        
+        with col1:
+            uploaded_file = st.file_uploader("📂 Carica Referto", type=['pdf', 'png', 'jpg'])
+            # L'estrazione parte subito, in background, mentre si scrivono le note
+            chiave_referto = avvia_referto(uploaded_file) if uploaded_file else None
+        with col2:
+            note_manuali = st.text_area("📝 Note / Sintomi", height=100)
 
-            # PULSANTE GENERA
-            if st.button("✨ GENERA PIANO ALIMENTARE ✨", type="primary", use_container_width=True):
-                with st.spinner("⏳ Elaborazione intelligenza artificiale..."):
-                    if uploaded_file: testo_ai += f" [FILE: {uploaded_file.name}] "
-                    if note_manuali: testo_ai += f" {note_manuali} "
-                    if not testo_ai: testo_ai = "Nessun dato fornito."
+        # PULSANTE GENERA
+        piani = cache_piani()
+        strutturato = piano_strutturato_attivo()
+        rigenera = piani is not None and st.checkbox("🔁 Rigenera comunque (ignora i piani già generati)")
+        if st.button("✨ GENERA PIANO ALIMENTARE ✨", type="primary", use_container_width=True):
+            allegati = []
+            if uploaded_file:
+                testo_ai += f" [FILE: {uploaded_file.name}] "
+                if chiave_referto is not None:
+                    with st.spinner("📄 Lettura del referto..."):
+                        referto = estrattore_referti().risultato(chiave_referto)
+                    for avviso in referto["avvisi"]:
+                        st.caption(f"⚠️ {avviso}")
+                    if referto["testo"]:
+                        testo_ai += f"\nTESTO DEL REFERTO:\n{referto['testo']}\n"
+                    if referto["parti"]:
+                        # L'impronta nel testo distingue i piani in cache per allegato
+                        testo_ai += f" [ALLEGATO {chiave_referto[:16]}] "
+                        allegati = referto["parti"]
+            if note_manuali: testo_ai += f" {note_manuali} "
+            if not testo_ai: testo_ai = "Nessun dato fornito."
 
+            # Stessi dati = stesso piano: se l'abbiamo già generato lo riusiamo
+            chiave_piano = None
+            dalla_cache = None
+            st.session_state['bozza_piano'] = None
+            if piani is not None:
+                chiave_piano = CachePiani.chiave(
+                    componi_prompt(testo_ai, testo_cella(dati.get('stile_guida')), obiettivo, fisico),
+                    MODELLO_GEMINI + ("+json" if strutturato else "")
+                )
+                if not rigenera:
+                    dalla_cache = piani.leggi(chiave_piano)
+                    metriche().conta("cache_piani", esito="miss" if dalla_cache is None else "hit")
+
+            if dalla_cache is not None:
+                if strutturato:
+                    st.session_state['bozza_piano'] = json.loads(dalla_cache)
+                    dalla_cache = piano_in_markdown(st.session_state['bozza_piano'])
+                st.session_state['bozza_temp'] = dalla_cache
+                st.session_state['tempi_generazione'] = None
+                st.toast("♻️ Piano già generato con gli stessi dati: recuperato dalla cache")
+            elif strutturato:
+                # Il JSON a metà non si può mostrare: niente streaming in questa modalità
+                with st.spinner("⏳ Elaborazione intelligenza artificiale..."):
+                    piano, errore = genera_piano_strutturato(
+                        testo_ai, testo_cella(dati.get('stile_guida')), obiettivo, fisico, allegati
+                    )
+                st.session_state['bozza_piano'] = piano
+                st.session_state['bozza_temp'] = errore or piano_in_markdown(piano)
+                st.session_state['tempi_generazione'] = None
+            elif streaming_attivo():
+                # Il testo arriva in un thread: lo mostra (e lo salva) avanzamento_generazione()
+                st.session_state['bozza_temp'] = ""
+                st.session_state['tempi_generazione'] = None
+                st.session_state['generazione'] = GenerazioneStreaming(
+                    genera_piano_streaming(testo_ai, testo_cella(dati.get('stile_guida')), obiettivo, fisico, allegati),
+                    chiave_piano if dalla_cache is None else None,
+                )
+                chiave_piano = None
+            else:
+                with st.spinner("⏳ Elaborazione intelligenza artificiale..."):
                     bozza = genera_piano_nutrizionale(
                         testo_ai, 
-                        dati['stile_guida'], 
+                        testo_cella(dati.get('stile_guida')), 
                         obiettivo, 
-                        fisico
+                        fisico,
+                        allegati
                     )
                     st.session_state['bozza_temp'] = bozza
-            
-            # SEZIONE REVISIONE E INVIO
-            if 'bozza_temp' in st.session_state:
-                st.markdown("---")
+
+            # Non mettiamo in cache gli errori
+            if dalla_cache is None and chiave_piano is not None and "Errore generazione AI" not in st.session_state['bozza_temp']:
+                piano = st.session_state['bozza_piano']
+                piani.salva(chiave_piano, st.session_state['bozza_temp'] if piano is None else json_compatto(piano))
+        
+        # SEZIONE REVISIONE E INVIO
+        if st.session_state.get('generazione') is not None:
+            avanzamento_generazione()
+        elif 'bozza_temp' in st.session_state:
+            st.markdown("---")
+            tempi = st.session_state.get('tempi_generazione')
+            if tempi and tempi[0] is not None:
+                st.caption(f"⚡ Primo testo dopo {tempi[0]:.1f}s, piano completo in {tempi[1]:.1f}s")
+            bozza_piano = st.session_state.get('bozza_piano')
+            if bozza_piano is not None:
+                # Revisione sulla struttura: una riga per alimento
+                st.caption("Revisione: modifica, aggiungi o togli righe (una per alimento).")
+                tabella = st.data_editor(
+                    piano_in_tabella(bozza_piano), num_rows="dynamic", use_container_width=True,
+                    key=f"revisione_{impronta_piano(bozza_piano)}",
+                )
+                note_piano = st.text_area("Note del piano:", value=bozza_piano.get("note", ""))
+                piano_finale = piano_da_tabella(tabella, note_piano)
+                dieta_finale = piano_in_markdown(piano_finale)
+                with st.expander("👁️ Anteprima"):
+                    st.markdown(dieta_finale)
+            else:
+                piano_finale = None
                 dieta_finale = st.text_area("Revisione:", value=st.session_state['bozza_temp'], height=500)
+            
+            # --- BLOCCO SALVATAGGIO DATABASE ---
+            if st.button("💾 SALVA NEL DATABASE (Storico)", use_container_width=True):
+                if piano_finale is not None:
+                    # JSON compatto: solo i pasti cambiati rispetto al piano precedente
+                    testo_dieta = codifica_piano(piano_finale, *piano_precedente(cliente_sel))
+                else:
+                    testo_dieta = dieta_finale
+                nuova_riga = pd.DataFrame([{
+                    "cliente_username": cliente_sel,
+                    "data_assegnazione": datetime.now().strftime("%d/%m/%Y"),
+                    "testo_dieta": testo_dieta,
+                    "note_studio": "Generata via App"
+                }])
                 
-                # --- BLOCCO SALVATAGGIO DATABASE ---
-                if st.button("💾 SALVA NEL DATABASE (Storico)", use_container_width=True):
-                    df_diete = leggi_tab("DIETE")
-                    nuova_riga = pd.DataFrame([{
-                        "cliente_username": cliente_sel,
-                        "data_assegnazione": datetime.now().strftime("%d/%m/%Y"),
-                        "testo_dieta": dieta_finale,
-                        "note_studio": "Generata via App"
-                    }])
-                    
-                    # Usa concat per preparare il dataframe completo (anche se scrivi_tab usa gspread append)
-                    df_completo = pd.concat([df_diete, nuova_riga], ignore_index=True)
-                    
-                    if scrivi_tab("DIETE", df_completo):
-                        st.balloons()
+                # Solo la riga nuova: lo storico di DIETE non serve per salvare
+                if scrivi_righe("DIETE", nuova_riga):
+                    st.balloons()
+                    stato = stato_ultima_scrittura()
+                    if stato == CodaScritture.SALVATO:
                         st.success("✅ Salvato nello storico del cliente!")
+                    elif stato == CodaScritture.SCARTATO:
+                        st.error("❌ Il foglio ha rifiutato il piano: non è stato salvato.")
+                    else:
+                        st.info("⏳ Piano in coda: sarà salvato nello storico tra pochi secondi.")
 
-                st.markdown("---")
-                st.subheader("📤 Invia al Paziente (o a te stesso)")
-                
-                # --- BLOCCO INVIO CON CAMPI EDITABILI ---
-                c_edit, c_send = st.columns([1, 1], gap="large")
-                
-                with c_edit:
-                    st.caption("Modifica qui sotto per inviare a un numero/email diverso")
-                    # Campi modificabili (precompilati con dati DB)
-                    dest_tel = st.text_input("📱 Telefono (con prefisso 39...)", value=tel_db)
-                    dest_email = st.text_input("📧 Email", value=email_db)
-                    
-                    # Pulsante per salvare i nuovi contatti nel DB per il futuro
-                    if (dest_tel != tel_db or dest_email != email_db) and st.button("🔄 Aggiorna Rubrica Clienti"):
-                        # Logica di aggiornamento (Un po' complessa, ricarichiamo tutto il foglio Clienti)
-                        df_c = leggi_tab("CLIENTI")
-                        # Trova l'indice della riga
-                        idx = df_c.index[df_c['username'] == cliente_sel].tolist()[0]
-                        # Aggiorna
-                        df_c.at[idx, 'telefono'] = dest_tel
-                        df_c.at[idx, 'email'] = dest_email
-                        # Salva (sovrascrive scheda Clienti)
-                        # Nota: Qui usiamo conn.update perché stiamo modificando una riga esistente
-                        try:
-                            conn.update(worksheet="CLIENTI", data=df_c)
-                            st.cache_data.clear()
-                            st.success("Rubrica aggiornata!")
-                            time.sleep(1)
-                            st.rerun()
-                        except Exception as e:
-                            st.error(f"Errore aggiornamento rubrica: {e}")
+            st.markdown("---")
+            sezione_invio(cliente_sel, dieta_finale, tel_db, email_db)
 
-                with c_send:
-                    st.caption("Clicca per aprire l'app corrispondente")
-                    testo_encoded = urllib.parse.quote(f"Ciao {cliente_sel}, ecco il tuo piano nutrizionale:\n\n{dieta_finale}")
-                    
-                    # WhatsApp Logic
-                    if dest_tel:
-                        # Rimuovi spazi e + se presenti
-                        clean_tel = dest_tel.replace("+", "").replace(" ", "")
-                        link_wa = f"https://wa.me/{clean_tel}?text={testo_encoded}"
-                        st.link_button("🟢 Invia su WhatsApp", link_wa, use_container_width=True)
-                    else:
-                        st.button("No Telefono inserito", disabled=True, use_container_width=True)
+        # GENERAZIONE MULTIPLA (più pazienti in parallelo)
+        st.write("---")
+        sezione_generazione_multipla(dati)
 
-                    # Email Logic
-                    if dest_email and "@" in dest_email:
-                        link_mail = f"mailto:{dest_email}?subject=Il tuo Piano Nutrizionale&body={testo_encoded}"
-                        st.link_button("📧 Invia per Email", link_mail, use_container_width=True)
-                    else:
-                        st.button("No Email inserita", disabled=True, use_container_width=True)
 
-    # TAB 2: GESTIONE CLIENTI (Visualizzazione + Creazione)
-    with tabs[1]:
-        st.subheader("👥 I Tuoi Pazienti")
+@st.fragment(run_every=0.5)
+def avanzamento_generazione():
+    """Testo della generazione in streaming, riletto ogni mezzo secondo finché non finisce"""
+    generazione = st.session_state['generazione']
+    if st.button("⏹ Interrompi generazione"):
+        generazione.ferma()
+    testo, primo_testo, durata, finita = generazione.stato()
+    if not finita:
+        st.markdown(testo or "⏳ In attesa del primo testo...")
+        return
+    # Finita (o interrotta): il testo passa nella bozza e si ridisegna la revisione
+    st.session_state['bozza_temp'] = testo
+    st.session_state['tempi_generazione'] = (primo_testo, durata)
+    del st.session_state['generazione']
+    piani = cache_piani()
+    # Non mettiamo in cache gli errori né i piani interrotti a metà
+    if (piani is not None and generazione.chiave_piano is not None and not generazione.interrotta
+            and "Errore generazione AI" not in testo):
+        piani.salva(generazione.chiave_piano, testo)
+    st.rerun()
+
+
+@st.fragment
+@misurato("frammento", funzione="sezione_invio")
+def sezione_invio(cliente_sel, dieta_finale, tel_db, email_db):
+    """Invio WhatsApp/Email e aggiornamento rubrica (si riesegue da sola)"""
+    st.subheader("📤 Invia al Paziente (o a te stesso)")
+    
+    # --- BLOCCO INVIO CON CAMPI EDITABILI ---
+    c_edit, c_send = st.columns([1, 1], gap="large")
+    
+    with c_edit:
+        st.caption("Modifica qui sotto per inviare a un numero/email diverso")
+        # Campi modificabili (precompilati con dati DB)
+        dest_tel = st.text_input("📱 Telefono (con prefisso 39...)", value=tel_db)
+        dest_email = st.text_input("📧 Email", value=email_db)
         
-        # 1. VISUALIZZAZIONE LISTA
-        df_c = leggi_tab("CLIENTI")
-        # Filtra solo i clienti di questo studio
-        miei_pazienti = df_c[df_c['studio_riferimento'] == dati['username']]
+        # Pulsante per salvare i nuovi contatti nel DB per il futuro
+        if (dest_tel != tel_db or dest_email != email_db) and st.button("🔄 Aggiorna Rubrica Clienti"):
+            # Scriviamo solo le due celle della riga del paziente, controllando
+            # che nessuno le abbia cambiate dopo la nostra lettura
+            try:
+                aggiornato = aggiorna_riga(
+                    "CLIENTI", "username", cliente_sel,
+                    {"telefono": dest_tel, "email": dest_email},
+                    attesi={"telefono": tel_db, "email": email_db},
+                )
+                if aggiornato:
+                    st.success("Rubrica aggiornata!")
+                    time.sleep(1)
+                    st.rerun()
+                else:
+                    st.error("Paziente non trovato nel foglio Clienti.")
+            except ConflittoAggiornamento as e:
+                cache_fogli().invalida("CLIENTI")
+                st.warning(f"⚠️ Contatti modificati da un altro utente: {e}")
+            except Exception as e:
+                st.error(f"Errore aggiornamento rubrica: {e}")
+
+    with c_send:
+        st.caption("Clicca per aprire l'app corrispondente")
+        testo_encoded = urllib.parse.quote(f"Ciao {cliente_sel}, ecco il tuo piano nutrizionale:\n\n{dieta_finale}")
         
-        if not miei_pazienti.empty:
-            # Selezioniamo solo le colonne utili da mostrare (nascondiamo password e studio)
-            colonne_visibili = ['username', 'nome_completo', 'email', 'telefono', 'dati_fisici', 'obiettivo_specifico']
-            # Filtriamo per essere sicuri che le colonne esistano (in caso di vecchie versioni del foglio)
-            cols_reali = [c for c in colonne_visibili if c in miei_pazienti.columns]
-            
-            # Mostra la tabella
-            st.dataframe(
-                miei_pazienti[cols_reali], 
-                use_container_width=True, 
-                hide_index=True
-            )
-            st.caption(f"Totale pazienti: {len(miei_pazienti)}")
+        # WhatsApp Logic
+        if dest_tel:
+            # Rimuovi spazi e + se presenti
+            clean_tel = dest_tel.replace("+", "").replace(" ", "")
+            link_wa = f"https://wa.me/{clean_tel}?text={testo_encoded}"
+            st.link_button("🟢 Invia su WhatsApp", link_wa, use_container_width=True)
         else:
-            st.info("Non hai ancora inserito nessun paziente.")
+            st.button("No Telefono inserito", disabled=True, use_container_width=True)
 
-        st.write("---")
+        # Email Logic
+        if dest_email and "@" in dest_email:
+            link_mail = f"mailto:{dest_email}?subject=Il tuo Piano Nutrizionale&body={testo_encoded}"
+            st.link_button("📧 Invia per Email", link_mail, use_container_width=True)
+        else:
+            st.button("No Email inserita", disabled=True, use_container_width=True)
 
-        # 2. CREAZIONE NUOVO (Dentro un expander per pulizia)
-        with st.expander("➕ AGGIUNGI NUOVO PAZIENTE", expanded=False):
-            with st.form("new_client"):
-                c1, c2 = st.columns(2)
-                with c1:
-                    nc_user = st.text_input("Username (univoco per login)")
-                    nc_pass = st.text_input("Password (per il paziente)")
-                    nc_nome = st.text_input("Nome e Cognome")
-                with c2:
-                    nc_email = st.text_input("Email")
-                    nc_tel = st.text_input("Telefono (es. 39333...)")
-                    nc_dati = st.text_input("Dati Fisici (es. 80kg, 180cm)")
-                
-                nc_obiett = st.text_input("Obiettivo Specifico")
-                
-                if st.form_submit_button("Salva Nuovo Paziente"):
-                    # Rileggiamo il DF per essere sicuri di avere l'ultima versione
-                    df_c_fresh = leggi_tab("CLIENTI")
-                    
-                    if nc_user in df_c_fresh['username'].values:
-                        st.error("⚠️ Username già esistente! Scegline un altro.")
-                    else:
-                        new_row = pd.DataFrame([{
-                            "username": nc_user,
-                            "password": nc_pass,
-                            "nome_completo": nc_nome,
-                            "studio_riferimento": dati['username'],
-                            "dati_fisici": nc_dati,
-                            "obiettivo_specifico": nc_obiett,
-                            "email": nc_email,
-                            "telefono": nc_tel
-                        }])
-                        
-                        # Usiamo concat + scrivi_tab
-                        df_updated = pd.concat([df_c_fresh, new_row], ignore_index=True)
-                        
-                        if scrivi_tab("CLIENTI", df_updated):
-                            st.success(f"✅ Paziente {nc_nome} creato con successo!")
-                            time.sleep(1)
-                            st.rerun() # Ricarica la pagina per vederlo subito in tabella
 
-# TAB 3: SETTINGS (Impostazioni Studio)
-    with tabs[2]:
-        st.header("⚙️ Personalizza il tuo Studio")
-        st.write("Qui puoi modificare il logo che vedono i clienti e istruire l'IA sul tuo metodo di lavoro.")
+@st.fragment
+@misurato("frammento", funzione="sezione_generazione_multipla")
+def sezione_generazione_multipla(dati):
+    clienti = rubrica("CLIENTI")
+    miei_clienti = clienti.clienti_di(dati['username'])
+    with st.expander("📦 Genera piani per più pazienti", expanded=False):
+        selezionati = st.multiselect("Pazienti", miei_clienti['username'].tolist())
+        note_comuni = st.text_area("📝 Note comuni a tutti i pazienti", height=80)
+        
+        if st.button("✨ GENERA PIANI SELEZIONATI", disabled=not selezionati, use_container_width=True):
+            piani = cache_piani()
+            bozze = {}
+            richieste = {}
+            for username in selezionati:
+                riga = clienti.cliente_di(dati['username'], username)
+                prompt = componi_prompt(
+                    note_comuni or "Nessun dato fornito.",
+                    testo_cella(dati.get('stile_guida')),
+                    testo_cella(riga.get('obiettivo_specifico'), 'Standard'),
+                    testo_cella(riga.get('dati_fisici'), '-'),
+                )
+                # I piani già generati con gli stessi dati non costano una chiamata
+                testo = piani.leggi(CachePiani.chiave(prompt, MODELLO_GEMINI)) if piani is not None else None
+                if testo is not None:
+                    bozze[username] = testo
+                else:
+                    richieste[username] = prompt
+
+            errori = {}
+            avanzamento = st.progress(0.0, text="⏳ Generazione in corso...")
+            fatti = len(bozze)
+            avanzamento.progress(fatti / len(selezionati), text=f"⏳ {fatti}/{len(selezionati)} piani pronti")
+            for username, testo, errore in genera_piani_in_blocco(richieste):
+                if errore:
+                    errori[username] = errore
+                else:
+                    bozze[username] = testo
+                    if piani is not None:
+                        piani.salva(CachePiani.chiave(richieste[username], MODELLO_GEMINI), testo)
+                fatti += 1
+                avanzamento.progress(fatti / len(selezionati), text=f"⏳ {fatti}/{len(selezionati)} piani pronti")
+            st.session_state['bozze_multiple'] = bozze
+            for username, errore in errori.items():
+                st.error(f"❌ {username}: {errore}")
+
+        bozze = st.session_state.get('bozze_multiple', {})
+        if bozze:
+            st.caption(f"{len(bozze)} piani pronti da salvare")
+            for username, testo in bozze.items():
+                with st.popover(f"👤 {username}"):
+                    st.markdown(testo)
+            
+            # Un solo append_rows per tutti i piani
+            if st.button("💾 SALVA TUTTI NEL DATABASE (Storico)", use_container_width=True):
+                oggi = datetime.now().strftime("%d/%m/%Y")
+                nuove_righe = pd.DataFrame([
+                    {
+                        "cliente_username": username,
+                        "data_assegnazione": oggi,
+                        "testo_dieta": testo,
+                        "note_studio": "Generata via App (multipla)"
+                    }
+                    for username, testo in bozze.items()
+                ])
+                if scrivi_righe("DIETE", nuove_righe):
+                    del st.session_state['bozze_multiple']
+                    st.success(f"✅ {len(nuove_righe)} piani salvati nello storico!")
+
 
-        with st.form("settings_form"):
-            # Recuperiamo i valori attuali gestendo eventuali "nan" (vuoti)
-            current_logo = str(dati.get('logo_url', ''))
-            if current_logo == "nan": current_logo = ""
+# TAB 2: GESTIONE CLIENTI (Visualizzazione + Creazione)
+@st.fragment
+@misurato("frammento", funzione="tab_gestione_clienti")
+def tab_gestione_clienti(dati):
+    st.subheader("👥 I Tuoi Pazienti")
+    
+    # 1. VISUALIZZAZIONE LISTA
+    # Solo i clienti di questo studio (indice per studio, niente scansione)
+    miei_pazienti = rubrica("CLIENTI").clienti_di(dati['username'])
+    
+    if not miei_pazienti.empty:
+        # Selezioniamo solo le colonne utili da mostrare (nascondiamo password e studio)
+        colonne_visibili = ['username', 'nome_completo', 'email', 'telefono', 'dati_fisici', 'obiettivo_specifico']
+        # Filtriamo per essere sicuri che le colonne esistano (in caso di vecchie versioni del foglio)
+        cols_reali = [c for c in colonne_visibili if c in miei_pazienti.columns]
+        
+        # Mostra la tabella
+        st.dataframe(
+            miei_pazienti[cols_reali], 
+            use_container_width=True, 
+            hide_index=True
+        )
+        st.caption(f"Totale pazienti: {len(miei_pazienti)}")
+    else:
+        st.info("Non hai ancora inserito nessun paziente.")
 
-            current_style = str(dati.get('stile_guida', ''))
-            if current_style == "nan": current_style = ""
+    st.write("---")
 
-            # Campi di input
-            new_logo = st.text_input("URL Logo (Link immagine)", value=current_logo)
-            st.caption("Incolla un link diretto a un'immagine (es. da imgur o dal tuo sito web).")
+    # 2. IMPORTAZIONE DA FILE (tanti pazienti, una sola scrittura)
+    with st.expander("📥 IMPORTA PAZIENTI DA FILE (CSV / Excel)", expanded=False):
+        importa_clienti(dati)
 
-            new_style = st.text_area("Stile Guida Nutrizionale (Prompt IA)", value=current_style, height=200)
-            st.caption("Istruisci l'IA: es. 'Prediligi dieta mediterranea', 'Usa tono severo', 'Escludi integratori'.")
+    # 3. CREAZIONE NUOVO (Dentro un expander per pulizia)
+    with st.expander("➕ AGGIUNGI NUOVO PAZIENTE", expanded=False):
+        with st.form("new_client"):
+            c1, c2 = st.columns(2)
+            with c1:
+                nc_user = st.text_input("Username (univoco per login)")
+                nc_pass = st.text_input("Password (per il paziente)")
+                nc_nome = st.text_input("Nome e Cognome")
+            with c2:
+                nc_email = st.text_input("Email")
+                nc_tel = st.text_input("Telefono (es. 39333...)")
+                nc_dati = st.text_input("Dati Fisici (es. 80kg, 180cm)")
             
-            # Pulsante di salvataggio
-            if st.form_submit_button("💾 Aggiorna Impostazioni"):
-                try:
-                    # 1. Leggiamo tutto il foglio CONFIG_STUDI
-                    df_studi = leggi_tab("CONFIG_STUDI")
+            nc_obiett = st.text_input("Obiettivo Specifico")
+            
+            if st.form_submit_button("Salva Nuovo Paziente"):
+                # Rileggiamo il DF per essere sicuri di avere l'ultima versione
+                df_c_fresh = leggi_tab("CLIENTI", forza=True)
+                
+                if rubrica("CLIENTI").trova(nc_user, ignora_maiuscole=False) is not None:
+                    st.error("⚠️ Username già esistente! Scegline un altro.")
+                else:
+                    new_row = pd.DataFrame([{
+                        "username": nc_user,
+                        "password": nc_pass,
+                        "nome_completo": nc_nome,
+                        "studio_riferimento": dati['username'],
+                        "dati_fisici": nc_dati,
+                        "obiettivo_specifico": nc_obiett,
+                        "email": nc_email,
+                        "telefono": nc_tel
+                    }])
                     
-                    # 2. Cerchiamo la riga del tuo studio
-                    # Puliamo le stringhe per sicurezza
-                    df_studi['username'] = df_studi['username'].astype(str).str.strip()
-                    target_user = str(dati['username']).strip()
+                    # Usiamo concat + scrivi_tab
+                    df_updated = pd.concat([df_c_fresh, new_row], ignore_index=True)
                     
-                    if target_user in df_studi['username'].values:
-                        # Troviamo l'indice della riga
-                        idx = df_studi.index[df_studi['username'] == target_user].tolist()[0]
-                        
-                        # 3. Aggiorniamo i valori in memoria
-                        df_studi.at[idx, 'logo_url'] = new_logo
-                        df_studi.at[idx, 'stile_guida'] = new_style
-                        
-                        # 4. Salvataggio su Google Sheets
-                        # NOTA: Qui usiamo conn.update perché stiamo MODIFICANDO, non aggiungendo
-                        conn.update(worksheet="CONFIG_STUDI", data=df_studi)
-                        st.cache_data.clear()
-                        
-                        # 5. Aggiorniamo la sessione locale (per vedere le modifiche subito)
-                        st.session_state.user_data['logo_url'] = new_logo
-                        st.session_state.user_data['stile_guida'] = new_style
-                        
-                        st.success("✅ Impostazioni aggiornate con successo!")
+                    if scrivi_tab("CLIENTI", df_updated):
+                        st.success(f"✅ Paziente {nc_nome} creato con successo!")
                         time.sleep(1)
-                        st.rerun()
-                    else:
-                        st.error("Errore critico: Impossibile trovare il tuo utente nel database per aggiornarlo.")
-                        
-                except Exception as e:
-                    st.error(f"Errore durante il salvataggio: {e}")
+                        st.rerun() # Ricarica la pagina per vederlo subito in tabella
+
+
+def importa_clienti(dati):
+    """Carica un CSV/XLSX, valida tutte le righe insieme e scrive le valide con un solo append"""
+    st.caption(
+        "Una riga per paziente, intestazioni come sul foglio: "
+        + ", ".join(c for c in COLONNE_CLIENTI if c != "studio_riferimento")
+        + f". Obbligatori: {', '.join(OBBLIGATORI_CLIENTI)}."
+    )
+    # Messaggio dell'import appena fatto, sopravvissuto al rerun
+    esito = st.session_state.pop("esito_import_clienti", None)
+    if esito:
+        st.success(esito)
+    # Chiave nuova dopo ogni import: l'uploader si svuota e l'anteprima non
+    # segna come "già esistenti" i pazienti appena importati
+    versione = st.session_state.get("versione_import_clienti", 0)
+    file = st.file_uploader("File pazienti", type=["csv", "xlsx"], key=f"file_import_clienti_{versione}")
+    if file is None:
+        return
+    max_righe = int(st.secrets.get("import", {}).get("max_righe", 5000))
+    try:
+        righe = leggi_file_clienti(file)
+    except ImportError:
+        st.error("Per i file Excel serve il pacchetto openpyxl: usa un CSV oppure installalo.")
+        return
+    except Exception as e:
+        st.error(f"File non leggibile: {e}")
+        return
+    if len(righe) > max_righe:
+        st.error(f"Troppe righe ({len(righe)}): al massimo {max_righe} per file.")
+        return
+
+    def valida(clienti):
+        esistenti = clienti['username'].dropna() if 'username' in clienti.columns else pd.Series(dtype="string")
+        return valida_import_clienti(righe, esistenti, dati['username'])
+
+    # Anteprima sull'istantanea in cache; all'import si ricontrolla sul foglio riletto
+    valide, report = valida(istantanea_tab("CLIENTI"))
+
+    scartate = report[report["esito"] != "ok"]
+    st.write(f"✅ {len(valide)} righe valide · ⚠️ {len(scartate)} con errori")
+    if not scartate.empty:
+        st.dataframe(scartate, hide_index=True, use_container_width=True)
+        st.download_button(
+            "⬇️ Scarica gli errori (CSV)", scartate.to_csv(index=False),
+            file_name="errori_import.csv", mime="text/csv",
+        )
+
+    if not valide.empty and st.button(f"📥 Importa {len(valide)} pazienti", type="primary"):
+        # Altri studi possono aver aggiunto clienti dopo l'anteprima
+        clienti = istantanea_tab("CLIENTI", forza=True)
+        valide, report = valida(clienti)
+        # Stesso ordine di colonne del foglio: append_rows scrive per posizione
+        colonne = list(clienti.columns) if not clienti.empty else COLONNE_CLIENTI
+        if not valide.empty and scrivi_righe("CLIENTI", valide.reindex(columns=colonne, fill_value="")):
+            st.session_state.esito_import_clienti = f"✅ Importati {len(valide)} pazienti."
+            st.session_state.versione_import_clienti = versione + 1
+            st.rerun()
+
+
+# TAB 3: SETTINGS (Impostazioni Studio)
+@st.fragment
+@misurato("frammento", funzione="tab_impostazioni")
+def tab_impostazioni(dati):
+    st.header("⚙️ Personalizza il tuo Studio")
+    st.write("Qui puoi modificare il logo che vedono i clienti e istruire l'IA sul tuo metodo di lavoro.")
+
+    with st.form("settings_form"):
+        # Recuperiamo i valori attuali (celle vuote = "")
+        current_logo = testo_cella(dati.get('logo_url'))
+        current_style = testo_cella(dati.get('stile_guida'))
+
+        # Campi di input
+        new_logo = st.text_input("URL Logo (Link immagine)", value=current_logo)
+        st.caption("Incolla un link diretto a un'immagine (es. da imgur o dal tuo sito web).")
+
+        new_style = st.text_area("Stile Guida Nutrizionale (Prompt IA)", value=current_style, height=200)
+        st.caption("Istruisci l'IA: es. 'Prediligi dieta mediterranea', 'Usa tono severo', 'Escludi integratori'.")
+        
+        # Pulsante di salvataggio
+        if st.form_submit_button("💾 Aggiorna Impostazioni"):
+            try:
+                # 1. Scriviamo solo le due celle della riga del tuo studio
+                #    (se nel frattempo sono cambiate, non le sovrascriviamo)
+                target_user = str(dati['username']).strip()
+                aggiornato = aggiorna_riga(
+                    "CONFIG_STUDI", "username", target_user,
+                    {"logo_url": new_logo, "stile_guida": new_style},
+                    attesi={"logo_url": current_logo, "stile_guida": current_style},
+                )
+                
+                if aggiornato:
+                    # 2. Aggiorniamo la sessione locale (per vedere le modifiche subito)
+                    st.session_state.user_data['logo_url'] = new_logo
+                    st.session_state.user_data['stile_guida'] = new_style
+                    
+                    st.success("✅ Impostazioni aggiornate con successo!")
+                    time.sleep(1)
+                    st.rerun()
+                else:
+                    st.error("Errore critico: Impossibile trovare il tuo utente nel database per aggiornarlo.")
+                    
+            except ConflittoAggiornamento as e:
+                cache_fogli().invalida("CONFIG_STUDI")
+                st.warning(f"⚠️ Impostazioni modificate altrove: {e}")
+            except Exception as e:
+                st.error(f"Errore durante il salvataggio: {e}")
 
 # ==========================================
 # DASHBOARD CLIENTE
@@ -537,33 +3302,71 @@ def dashboard_cliente():
     
     with st.sidebar:
         if studio is not None:
-            logo = str(studio.get('logo_url', ''))
-            if logo and logo.lower() != "nan":
+            logo = testo_cella(studio.get('logo_url'))
+            if logo:
                 st.image(logo, use_container_width=True)
             st.caption(f"Studio: {studio['nome_studio']}")
         if st.button("Esci"): logout()
 
     st.title(f"Ciao, {dati['nome_completo']}")
     
-    df_diete = leggi_tab("DIETE")
-    my_diets = df_diete[df_diete['cliente_username'] == dati['username']]
+    # Solo l'ultimo piano: non serve scaricare lo storico di tutti i clienti
+    # (totale None: archivio non raggiungibile, l'avviso è già a schermo)
+    piani, totale = storico_piani(dati['username'], salta=0, limite=1)
+    ultima = None if piani.empty else piani.iloc[0]
     
-    if not my_diets.empty:
-        ultima = my_diets.iloc[-1]
-        st.info(f"📅 Piano del {ultima['data_assegnazione']}")
+    if ultima is not None:
+        st.info(f"📅 Piano del {testo_cella(ultima['data_assegnazione'], '-')}")
         with st.container(border=True):
-            st.markdown(ultima['testo_dieta'])
-    else:
+            st.markdown(testi_piani(dati['username'], [ultima['testo_dieta']], salta=0)[0])
+        
+        # STORICO (caricato solo su richiesta, una pagina alla volta)
+        if st.toggle("📚 Mostra piani precedenti"):
+            per_pagina = 5
+            pagina = st.session_state.get('pagina_storico', 0)
+            # 1 + ...: il piano più recente è già mostrato sopra
+            salta = 1 + pagina * per_pagina
+            piani, totale = storico_piani(dati['username'], salta=salta, limite=per_pagina)
+            
+            if piani.empty:
+                st.caption("Nessun piano precedente.")
+            else:
+                testi = testi_piani(dati['username'], piani['testo_dieta'].tolist(), salta)
+                for (_, piano), testo in zip(piani.iterrows(), testi):
+                    with st.expander(f"📅 Piano del {testo_cella(piano['data_assegnazione'], '-')}"):
+                        st.markdown(testo)
+            
+            pagine = max(1, -(-((totale or 1) - 1) // per_pagina))
+            c_prec, c_info, c_succ = st.columns([1, 2, 1])
+            with c_prec:
+                if st.button("◀ Più recenti", disabled=pagina == 0):
+                    st.session_state.pagina_storico = pagina - 1
+                    st.rerun()
+            with c_info:
+                st.caption(f"Pagina {pagina + 1} di {pagine}")
+            with c_succ:
+                if st.button("Più vecchi ▶", disabled=pagina + 1 >= pagine):
+                    st.session_state.pagina_storico = pagina + 1
+                    st.rerun()
+    elif totale is not None:
         st.warning("Il tuo nutrizionista non ha ancora caricato il piano.")
 
 # ==========================================
 # MAIN LOOP
 # ==========================================
-if not st.session_state.logged_in:
-    login_page()
-else:
-    if st.session_state.role == "studio":
-        dashboard_studio()
-    elif st.session_state.role == "cliente":
-        dashboard_cliente()
+pagina = st.session_state.role if st.session_state.logged_in else "login"
+with metriche().span("rerun", pagina=pagina):
+    if not st.session_state.logged_in:
+        login_page()
+        # Solo il primo login disegnato dal processo (cold start)
+        tempi_avvio().registra("primo_disegno_login", time.perf_counter() - INIZIO_SCRIPT)
+    else:
+        if st.session_state.role == "studio":
+            dashboard_studio()
+        elif st.session_state.role == "cliente":
+            dashboard_cliente()
+
+coda = coda_scritture()
+if coda is not None:
+    metriche().imposta("coda_scritture_righe", coda.in_coda())
 
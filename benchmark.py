@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark offline di app.py: nessuna chiamata reale a Google Sheets o Gemini.
+
+Sostituisce GSheetsConnection, gspread e genai.GenerativeModel con versioni
+finte in memoria (latenza e dimensione dei fogli configurabili), poi guida
+login_page, dashboard_studio e dashboard_cliente con l'AppTest di Streamlit.
+Per ogni dimensione dei fogli riporta latenza dei rerun, chiamate al backend
+e picco di memoria.
+
+Esempi:
+    python benchmark.py
+    python benchmark.py --righe 1000 10000 --latenza-ms 80 --ripetizioni 5
+    python benchmark.py --salva   # scrive anche bench_output.txt
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter
+
+import pandas as pd
+from streamlit.connections import BaseConnection
+from streamlit.testing.v1 import AppTest
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(CARTELLA, "app.py")
+
+# ==========================================
+# BACKEND FINTI
+# ==========================================
+class BackendFinto:
+    """Fogli in memoria + contatore delle chiamate, condivisi dai finti client"""
+
+    def __init__(self, latenza_ms=50, ms_per_mille_righe=20):
+        self.latenza = latenza_ms / 1000
+        self.per_riga = ms_per_mille_righe / 1000 / 1000
+        self.fogli = {}
+        self.chiamate = Counter()
+        self.modifiche = 0  # Versione del documento, cresce a ogni scrittura
+        self._lock = threading.Lock()
+
+    def attesa(self, tipo, righe=0):
+        """Conta la chiamata e simula rete + trasferimento"""
+        with self._lock:
+            self.chiamate[tipo] += 1
+        time.sleep(self.latenza + righe * self.per_riga)
+
+    def valori(self, nome_tab):
+        """Il foglio come lo restituisce gspread: liste di stringhe, intestazione inclusa"""
+        df = self.fogli[nome_tab]
+        righe = df.astype(object).where(df.notna(), "").astype(str).values.tolist()
+        return [list(df.columns)] + righe
+
+
+BACKEND = BackendFinto()
+
+
+class GSheetsConnectionFinta(BaseConnection):
+    def _connect(self, **kwargs):
+        return None
+
+    def read(self, worksheet=None, ttl=None, **kwargs):
+        df = BACKEND.fogli[worksheet]
+        BACKEND.attesa("sheets.read", len(df))
+        return df.copy()
+
+    def update(self, worksheet=None, data=None, **kwargs):
+        BACKEND.attesa("sheets.update", len(data))
+        BACKEND.fogli[worksheet] = data.copy()
+        BACKEND.modifiche += 1
+
+
+class FoglioFinto:
+    def __init__(self, nome_tab):
+        self.nome_tab = nome_tab
+        self.title = nome_tab
+
+    def append_row(self, riga, **kwargs):
+        self.append_rows([riga])
+
+    def append_rows(self, righe, **kwargs):
+        BACKEND.attesa("gspread.append_rows", len(righe))
+        df = BACKEND.fogli[self.nome_tab]
+        nuove = pd.DataFrame([r + [""] * (len(df.columns) - len(r)) for r in righe], columns=df.columns)
+        BACKEND.fogli[self.nome_tab] = pd.concat([df, nuove], ignore_index=True)
+        BACKEND.modifiche += 1
+        return {"updates": {"updatedRows": len(righe)}}
+
+    def row_values(self, numero, **kwargs):
+        BACKEND.attesa("gspread.row_values", 1)
+        valori = BACKEND.valori(self.nome_tab)
+        return valori[numero - 1] if numero <= len(valori) else []
+
+    def col_values(self, numero, **kwargs):
+        valori = BACKEND.valori(self.nome_tab)
+        BACKEND.attesa("gspread.col_values", len(valori) // 10)
+        return [r[numero - 1] for r in valori]
+
+    def _riga_iniziale(self, intervallo):
+        return int("".join(c for c in intervallo.split(":")[0] if c.isdigit()))
+
+    def get(self, intervallo=None, **kwargs):
+        valori = BACKEND.valori(self.nome_tab)[self._riga_iniziale(intervallo) - 1:]
+        BACKEND.attesa("gspread.get", len(valori))
+        return valori
+
+    def batch_get(self, intervalli, **kwargs):
+        BACKEND.attesa("gspread.batch_get", len(intervalli))
+        valori = BACKEND.valori(self.nome_tab)
+        return [[valori[self._riga_iniziale(i) - 1]] for i in intervalli]
+
+    def batch_update(self, dati, **kwargs):
+        BACKEND.attesa("gspread.batch_update", len(dati))
+        df = BACKEND.fogli[self.nome_tab]
+        for cella in dati:
+            col = "".join(c for c in cella["range"] if c.isalpha())
+            riga = int("".join(c for c in cella["range"] if c.isdigit()))
+            df.iloc[riga - 2, ord(col) - ord("A")] = cella["values"][0][0]
+        BACKEND.modifiche += 1
+
+
+class DocumentoFinto:
+    def worksheet(self, nome_tab):
+        BACKEND.attesa("gspread.worksheet")
+        return FoglioFinto(nome_tab)
+
+    def get_lastUpdateTime(self):
+        BACKEND.attesa("gspread.get_lastUpdateTime")
+        return BACKEND.modifiche
+
+
+class ClientFinto:
+    def open_by_url(self, url):
+        BACKEND.attesa("gspread.open_by_url")
+        return DocumentoFinto()
+
+
+class RispostaFinta:
+    def __init__(self, testo):
+        self.text = testo
+        self.usage_metadata = types.SimpleNamespace(prompt_token_count=400, candidates_token_count=len(testo) // 4)
+
+
+class ModelloFinto:
+    """Gemini finto: risposta fissa dopo la latenza configurata"""
+
+    def __init__(self, nome, **kwargs):
+        self.nome = nome
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        testo = "## Lunedì\nColazione: yogurt e frutta\nPranzo: pasta integrale\n" * 20
+        if stream:
+            return self._a_pezzi(testo)
+        BACKEND.attesa("gemini.generate_content")
+        return RispostaFinta(testo)
+
+    def _a_pezzi(self, testo):
+        BACKEND.attesa("gemini.generate_content")
+        for i in range(0, len(testo), 200):
+            yield RispostaFinta(testo[i:i + 200])
+
+
+def installa_finti():
+    """Sostituisce i client reali prima che AppTest esegua app.py"""
+    modulo = types.ModuleType("streamlit_gsheets")
+    modulo.GSheetsConnection = GSheetsConnectionFinta
+    sys.modules["streamlit_gsheets"] = modulo
+
+    import gspread
+    gspread.authorize = lambda creds: (BACKEND.attesa("gspread.authorize"), ClientFinto())[1]
+    from google.oauth2 import service_account
+    service_account.Credentials.from_service_account_info = classmethod(lambda cls, info, scopes=None: object())
+
+    import google.generativeai as genai
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = ModelloFinto
+
+
+def genera_fogli(righe, caratteri_piano=500):
+    """CONFIG_STUDI, CLIENTI e DIETE con `righe` righe ciascuno"""
+    studi = max(1, righe // 100)
+    BACKEND.fogli["CONFIG_STUDI"] = pd.DataFrame({
+        "username": [f"studio{i}" for i in range(righe)],
+        "password": [1234.0] * righe,
+        "nome_studio": [f"Studio {i}" for i in range(righe)],
+        "stile_guida": ["Dieta mediterranea"] * righe,
+        "logo_url": [None] * righe,
+        "data_iscrizione": ["01/01/2024"] * righe,
+        "pagato": ["SI"] * righe,
+    })
+    BACKEND.fogli["CLIENTI"] = pd.DataFrame({
+        "username": [f"cliente{i}" for i in range(righe)],
+        "password": ["pw"] * righe,
+        "nome_completo": [f"Cliente {i}" for i in range(righe)],
+        "studio_riferimento": [f"studio{i % studi}" for i in range(righe)],
+        "dati_fisici": ["80kg, 180cm"] * righe,
+        "obiettivo_specifico": ["Dimagrimento"] * righe,
+        "email": [f"cliente{i}@example.com" for i in range(righe)],
+        "telefono": [393330000000.0 + i for i in range(righe)],
+    })
+    BACKEND.fogli["DIETE"] = pd.DataFrame({
+        "cliente_username": [f"cliente{i % max(1, righe // 2)}" for i in range(righe)],
+        "data_assegnazione": ["01/02/2024"] * righe,
+        "testo_dieta": ["x" * caratteri_piano] * righe,
+        "note_studio": ["Generata via App"] * righe,
+    })
+
+
+SECRETS = {
+    "general": {"GEMINI_API_KEY": "finta"},
+    "connections": {"gsheets": {
+        "spreadsheet": "https://docs.google.com/spreadsheets/d/FINTO/edit",
+        "private_key": "finta",
+    }},
+}
+
+# ==========================================
+# SCENARI
+# ==========================================
+def nuova_app(timeout):
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    for chiave, valore in SECRETS.items():
+        at.secrets[chiave] = valore
+    return at
+
+
+def misura(nome, funzione, ripetizioni, memoria):
+    """Esegue funzione() (una prima volta a freddo, poi `ripetizioni` a caldo)"""
+    BACKEND.chiamate.clear()
+    if memoria:
+        tracemalloc.start()
+    inizio = time.perf_counter()
+    funzione()
+    freddo = time.perf_counter() - inizio
+    chiamate_freddo = sum(BACKEND.chiamate.values())
+
+    caldi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione()
+        caldi.append(time.perf_counter() - inizio)
+    picco = 0
+    if memoria:
+        _, picco = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "scenario": nome,
+        "freddo_ms": freddo * 1000,
+        "caldo_ms": (sum(caldi) / len(caldi) * 1000) if caldi else float("nan"),
+        "chiamate_freddo": chiamate_freddo,
+        "chiamate_totali": sum(BACKEND.chiamate.values()),
+        "dettaglio": dict(BACKEND.chiamate),
+        "picco_mb": picco / 1024 / 1024,
+    }
+
+
+def controlla(at, scenario):
+    if at.exception:
+        raise RuntimeError(f"{scenario}: {at.exception[0].message}")
+
+
+def scenari(righe, ripetizioni, memoria, timeout):
+    import streamlit as st
+    risultati = []
+
+    # 1. Login studio: form + submit (la lettura di CONFIG_STUDI avviene al submit)
+    st.cache_resource.clear()
+    at = nuova_app(timeout)
+
+    def login():
+        at.session_state.logged_in = False
+        at.run()
+        at.text_input[0].input(f"studio{righe - 1}")
+        at.text_input[1].input("1234")
+        at.button[0].click()
+        at.run()
+        controlla(at, "login_page")
+    risultati.append(misura("login_page (form+submit)", login, ripetizioni, memoria))
+
+    # 2. Dashboard studio, una tab alla volta (sessione già autenticata):
+    #    cache svuotate, così il primo rerun legge davvero i fogli
+    studio = BACKEND.fogli["CONFIG_STUDI"].iloc[0].copy()
+    for tab in ["📝 Genera Piano", "👥 Gestione Clienti", "⚙️ Impostazioni"]:
+        st.cache_resource.clear()
+        at = nuova_app(timeout)
+        at.run()
+        at.session_state.logged_in = True
+        at.session_state.role = "studio"
+        at.session_state.user_data = studio
+        at.session_state.tab_studio = tab
+
+        def rerun_studio():
+            at.run()
+            controlla(at, "dashboard_studio")
+        risultati.append(misura(f"dashboard_studio ({tab.split(' ', 1)[1]})", rerun_studio, ripetizioni, memoria))
+
+    # 3. Dashboard cliente (sessione già autenticata)
+    st.cache_resource.clear()
+    at = nuova_app(timeout)
+    at.run()
+    at.session_state.logged_in = True
+    at.session_state.role = "cliente"
+    at.session_state.user_data = pd.Series({
+        "username": "cliente0",
+        "nome_completo": "Cliente 0",
+        "studio_riferimento": "studio0",
+    })
+    at.session_state.linked_studio = None
+
+    def rerun_cliente():
+        at.run()
+        controlla(at, "dashboard_cliente")
+    risultati.append(misura("dashboard_cliente (rerun)", rerun_cliente, ripetizioni, memoria))
+    return risultati
+
+
+def formatta(tabella):
+    righe = [
+        f"{'righe':>8} | {'scenario':<36} | {'freddo ms':>10} | {'caldo ms':>9} | "
+        f"{'chiamate (freddo/tot)':>21} | {'picco MB':>8}",
+        "-" * 109,
+    ]
+    for n, r in tabella:
+        righe.append(
+            f"{n:>8} | {r['scenario']:<36} | {r['freddo_ms']:>10.1f} | {r['caldo_ms']:>9.1f} | "
+            f"{r['chiamate_freddo']:>10}/{r['chiamate_totali']:<10} | {r['picco_mb']:>8.1f}"
+        )
+    return "\n".join(righe)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--righe", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="righe per foglio (default: 1000 10000 100000)")
+    parser.add_argument("--latenza-ms", type=float, default=50, help="latenza finta per chiamata")
+    parser.add_argument("--ms-per-mille-righe", type=float, default=20, help="costo finto del trasferimento")
+    parser.add_argument("--caratteri-piano", type=int, default=500, help="lunghezza di testo_dieta")
+    parser.add_argument("--ripetizioni", type=int, default=3, help="rerun a caldo per scenario")
+    parser.add_argument("--senza-memoria", action="store_true", help="non misura il picco (più veloce)")
+    parser.add_argument("--timeout", type=float, default=600, help="timeout di AppTest per rerun (s)")
+    parser.add_argument("--dettaglio", action="store_true", help="mostra le chiamate per tipo")
+    parser.add_argument("--salva", action="store_true", help="scrive il report in bench_output.txt")
+    args = parser.parse_args()
+
+    BACKEND.latenza = args.latenza_ms / 1000
+    BACKEND.per_riga = args.ms_per_mille_righe / 1000 / 1000
+    installa_finti()
+
+    tabella = []
+    for n in args.righe:
+        genera_fogli(n, args.caratteri_piano)
+        for r in scenari(n, args.ripetizioni, not args.senza_memoria, args.timeout):
+            tabella.append((n, r))
+            if args.dettaglio:
+                print(f"{n:>8} | {r['scenario']:<36} | {r['dettaglio']}")
+
+    report = formatta(tabella)
+    print(report)
+    if args.salva:
+        with open(os.path.join(CARTELLA, "bench_output.txt"), "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()